@@ -1,15 +1,22 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 #import datetime
 import filecmp
 import os
-import io
+import json
+import hashlib
+import tempfile
+import threading
 import secret
+import concurrent.futures
 from common import *
 
 class IGAuthentications:
     # instagram API url
     insta_api = 'https://api.instagram.com/v1/'
     insta_media = 'users/self/media/recent/'
+    paths = {'media': insta_media}
     endpoints = {'media': insta_api+insta_media}
 
     # instagram API authentication
@@ -19,84 +26,151 @@ class IGAuthentications:
     # instagram accounts with access
     access = secret.ig_access
 
-    def get_endpoint(endpoint):
-        return IGAuthentications.endpoints[endpoint]
+    def get_endpoint(endpoint,api=None):
+        # full url of an endpoint, on another api root if given (such as a local stand-in)
+        if api is None:
+            url = IGAuthentications.endpoints[endpoint]
+        else:
+            url = api + IGAuthentications.paths[endpoint]
+        return url
+
+    def get_session(workers=8,retries=3,backoff=0.5):
+        # keep-alive session with a connection for each worker, retrying failed requests with backoff
+        retry = Retry(total=retries,backoff_factor=backoff,status_forcelist=[429,500,502,503,504],
+                      allowed_methods=['GET'])
+        adapter = HTTPAdapter(pool_connections=workers,pool_maxsize=workers,max_retries=retry)
+        session = requests.Session()
+        session.mount('http://',adapter)
+        session.mount('https://',adapter)
+        return session
 
     def get_token(username):
         token = {'access_token': IGAuthentications.access[username]}
         return token
 
 class IGAccount:
-    def __init__(self,username):
+    # media urls of an account, kept in a json file between runs when a sync path is given
+    # paging stops at the first post already seen, so a re-run only asks for new posts
+    def __init__(self,username,api=None,session=None,sync_path=None):
         self.username = username
         self.id = None
+        self.newest = None
         self.urls = {'profile':{},
                      'images':{},
                      'videos':{}}
-        self.endpoint = IGAuthentications.get_endpoint('media')
+        self.endpoint = IGAuthentications.get_endpoint('media',api)
         self.parameters = IGAuthentications.get_token(self.username)
+        self.session = session if session is not None else IGAuthentications.get_session()
+        self.sync_path = sync_path
 
     def ping(self):
         # contact Instagram API and get urls
-        ok = True
-        jason = None
+        # the newest post moves up only when paging ends on a post already seen or an empty page,
+        # and nothing is saved after a failed request, so a gap left by it is paged again on the next run
         print('Contacting Instagram API')
-        # get profile image
-        ok = self._get_profile()
-        if ok:
-            max_id = None
-            print(' + recent media')
-            while ok:
-                # get rest of images
-                max_id,ok = self._get_info(max_id)
+        self._load_sync()
 
-    def _id(self,id):
-        id = id.replace('_'+self.id,'')
-        return id
+        # the first page also gives the profile image
+        max_id = None
+        first = True
+        newest = None
+        status = 'more'
+        while status == 'more':
+            max_id,status,page_newest = self._get_info(max_id,first=first)
+            if first:
+                newest = page_newest
+            first = False
 
-    def _get_profile(self):
-        # get basic information
-        endpoint = IGAuthentications.get_endpoint('media')
-        parameters = IGAuthentications.get_token(self.username)
-        response = requests.get(endpoint,parameters)
+        if status == 'done':
+            if newest is not None:
+                self.newest = newest
+            self._save_sync()
 
-        if not response.ok:
-            print(' ...no response')
-        else:
-            print(' ...success')
-            jason = response.json()
-            print(' ...getting profile picture',end='')
+    def _load_sync(self):
+        # pick up the account from the last run
+        if (self.sync_path is not None) and os.path.isfile(self.sync_path):
+            try:
+                with open(self.sync_path,'r') as f:
+                    synced = json.load(f).get(self.username)
+            except (OSError,ValueError):
+                synced = None
+            if synced is not None:
+                self.id = synced['id']
+                self.newest = synced['newest']
+                self.urls = synced['urls']
+
+    def _save_sync(self):
+        # keep the account for the next run, alongside any other accounts
+        if self.sync_path is not None:
+            accounts = {}
+            if os.path.isfile(self.sync_path):
+                try:
+                    with open(self.sync_path,'r') as f:
+                        accounts = json.load(f)
+                except (OSError,ValueError):
+                    accounts = {}
+            accounts[self.username] = {'id':self.id,'newest':self.newest,'urls':self.urls}
+            temp_path = self.sync_path + '.tmp'
+            with open(temp_path,'w') as f:
+                json.dump(accounts,f)
+            os.replace(temp_path,self.sync_path)
 
-            # set id and get profile picture if first pass
-            if not self.id:
-                self.id = jason['data'][0]['user']['id']
-                profile_url = self._get_image_urls(jason['data'][0]['user'],self.id,'profile')
+    def _known(self,id):
+        # see if a post was collected on an earlier run
+        known = (id == self.newest) | (id in self.urls['images']) | (id in self.urls['videos'])
+        return known
 
-        return response.ok
+    def _id(self,id):
+        id = id.replace('_'+self.id,'')
+        return id
 
-    def _get_info(self,max_id):
-        # get all images from a user
-        endpoint = IGAuthentications.get_endpoint('media')
+    def _get_profile(self,user):
+        # set id and get profile picture from the user of a post
+        print(' ...getting profile picture',end='')
+        self.id = user['id']
+        self.urls['profile'] = {}
+        self._get_image_urls(user,self.id,'profile')
+
+    def _get_info(self,max_id,first=False):
+        # get images from a page of a user's posts, until reaching posts already seen
+        # status is 'more' to ask for the next page, 'done' at a known post or empty page, or 'failed'
+        endpoint = self.endpoint
         parameters = IGAuthentications.get_token(self.username)
 
         # continue from next page
         if max_id:
             parameters['max_id'] = max_id
 
-        response = requests.get(endpoint,parameters)
+        try:
+            response = self.session.get(endpoint,params=parameters)
+            ok = response.ok
+        except requests.RequestException:
+            ok = False
 
-        ok = response.ok
+        newest = None
+        status = 'more' if ok else 'failed'
+        if first:
+            print(' ...success' if ok else ' ...no response')
         if ok:
             # collect media from recent posts
             jason = response.json()
-            ok = len(jason['data']) > 0
-            if ok:
+            if len(jason['data']) == 0:
+                status = 'done'
+            else:
+                if first:
+                    self._get_profile(jason['data'][0]['user'])
+                    print(' + recent media')
+                    newest = jason['data'][0]['id']
+
                 max_id = jason['data'][-1]['id']
                 for j in jason['data']:
+                    if self._known(j['id']):
+                        status = 'done'
+                        break
                     media = self._get_media_type(j)
                     self._get_image_urls(j[media],j['id'],media)
             
-        return max_id,ok
+        return max_id,status,newest
 
     def _get_media_type(self,data):
         # returns if data is a carousel post or videos or images
@@ -123,63 +197,161 @@ class IGAccount:
                 url = data['standard_resolution']['url']
             self.urls[media][id] = url
 
+class IGHashIndex:
+    # sha256 of the files in a folder, kept in a json file between runs
+    # a file is hashed again only when its modified time or size changes
+    # downloads that matched a file already there are remembered so they are not fetched again
+    chunk_size = 2**16
+
+    def __init__(self,folder,path=None,extensions=['mp4']):
+        self.folder = folder
+        self.path = path
+        self.files = {}
+        self.duplicates = set()
+        self.lock = threading.Lock()
+
+        if (path is not None) and os.path.isfile(path):
+            try:
+                with open(path,'r') as f:
+                    index = json.load(f)
+                self.files = index['files']
+                self.duplicates = set(index['duplicates'])
+            except (OSError,ValueError,KeyError):
+                self.files = {}
+                self.duplicates = set()
+
+        self._update(extensions)
+
+    def _hash_file(self,filename):
+        # digest of a file read in chunks
+        digest = hashlib.sha256()
+        with open(filename,'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size),b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _update(self,extensions):
+        # hash files that are new or changed since the last run and drop files that are gone
+        files = {}
+        for filename,stat in Common.scan_files(self.folder,extensions):
+            entry = self.files.get(filename)
+            if (entry is None) or (entry[:2] != [stat.st_mtime_ns,stat.st_size]):
+                entry = [stat.st_mtime_ns,stat.st_size,self._hash_file(filename)]
+            files[filename] = entry
+        self.files = files
+        self.hashes = set(entry[2] for entry in self.files.values())
+
+    def claim(self,digest,filename):
+        # reserve a digest for a new file, or remember the file as a duplicate if it is taken
+        with self.lock:
+            unique = digest not in self.hashes
+            if unique:
+                self.hashes.add(digest)
+            else:
+                self.duplicates.add(filename)
+        return unique
+
+    def release(self,digest):
+        # give back a digest claimed for a file that was not saved
+        with self.lock:
+            self.hashes.discard(digest)
+
+    def add(self,filename,digest):
+        # record a file that was saved to the folder
+        stat = os.stat(filename)
+        with self.lock:
+            self.files[filename] = [stat.st_mtime_ns,stat.st_size,digest]
+
+    def save(self):
+        # write the index
+        if self.path is not None:
+            temp_path = self.path + '.tmp'
+            with open(temp_path,'w') as f:
+                json.dump({'files':self.files,'duplicates':sorted(self.duplicates)},f)
+            os.replace(temp_path,self.path)
+
 class IGDownloader:
+    chunk_size = 2**16
+
     def __init__(self,ig_account:IGAccount,photos_path='',videos_path='',
-                 profile_path='',download_path='downloads'):
+                 profile_path='',download_path='downloads',workers=8,hash_path=None):
         self.paths = {'profile':{'path':profile_path,'ext':'jpg'},
                       'images':{'path':photos_path,'ext':'jpg'},
                       'videos':{'path':videos_path,'ext':'mp4'}}
         self.download_path = download_path
         self.urls = ig_account.urls
+        self.session = ig_account.session
+        self.workers = workers
+        self.hash_path = hash_path
+        self.hashes = None
 
-    def _compare_files(self,url_content,files):
-        # check if a file has already been downloaded to folder
-        p = 0
-        unique = True
-        url_btye = io.BytesIO(url_content)
-        while unique & (p < len(files)):
-            file_byte = open(files[p])
-            unique = (url_byte != file_byte)
-            file_byte.close()
+    def _get_downloads(self):
+        # find media that is not in the download folders yet, listing each folder once
+        downloads = []
+        for media in self.urls:
+            if self.paths[media]['path'] is not False:
+                path = '{}/{}'.format(self.paths[media]['path'],self.download_path)
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                ext = self.paths[media]['ext']
+                files = set(Common.find_files(path))
 
-        return unique
+                for id in self.urls[media]:
+                    save_path = '{}/{}.{}'.format(path,id,ext)
+                    if (save_path not in files) & ((media != 'videos') or (save_path not in self.hashes.duplicates)):
+                        downloads.append((media,self.urls[media][id],save_path))
+
+        return downloads
+
+    def _download(self,media,url,save_path):
+        # stream url image or video to a temporary file while hashing it, returning if it was saved
+        # videos already in the folder under another name are discarded
+        # on any failure the temporary file is removed and a claimed digest is given back
+        saved = False
+        claimed = None
+        handle,temp_path = tempfile.mkstemp(suffix='.part',dir=os.path.dirname(save_path))
+        digest = hashlib.sha256()
+        try:
+            with os.fdopen(handle,'wb') as f, self.session.get(url,stream=True) as r:
+                r.raise_for_status()
+                for chunk in r.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+                    digest.update(chunk)
+
+            if media == 'videos':
+                if self.hashes.claim(digest.hexdigest(),save_path):
+                    claimed = digest.hexdigest()
+            if (media != 'videos') or (claimed is not None):
+                os.replace(temp_path,save_path)
+                saved = True
+                if media == 'videos':
+                    self.hashes.add(save_path,claimed)
+        except (requests.RequestException,OSError):
+            pass
+        finally:
+            if not saved:
+                if claimed is not None:
+                    self.hashes.release(claimed)
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+
+        return saved
 
     def download_media(self):
         # download files from urls
         print(' ...downloading new media')
 
         # check what videos already exists
-        collect_profile = (self.paths['profile']['path'] is not False)
         collect_videos = (self.paths['videos']['path'] is not False)
+        if collect_videos:
+            self.hashes = IGHashIndex(self.paths['videos']['path'],path=self.hash_path,extensions=[self.paths['videos']['ext']])
+
+        # fetch missing media over the shared session
+        downloads = self._get_downloads()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            saved = list(executor.map(lambda download: self._download(*download),downloads))
 
         if collect_videos:
-            videos = Common.find_files(self.paths['videos']['path'],[self.paths['videos']['path']])
-        
-        for media in self.urls:
-            path = '{}/{}'.format(self.paths[media]['path'],self.download_path)
-            if not os.path.isdir(path):
-                os.makedirs(path)
-            ext = self.paths[media]['ext']
-
-            # get file naming
-            for id in self.urls[media]: 
-                url = self.urls[media][id]
-                files = Common.find_files(path)
-                save_name = '{}.{}'.format(id,ext)
-                
-                # check if already downloaded
-                if '{}/{}'.format(path,save_name) not in files:
-                    # save url image or video to folder
-                    r = requests.get(url)
-
-                    # if file is a video, check if it has already been downloaded
-                    save_file = True
-
-                    if collect_videos & (media == 'videos'):
-                        save_file = self._compare_files(r.content,videos)
-
-                    if save_file:
-                        if (media == 'images') | ((media == 'videos') & collect_videos) | ((media == 'profile') & collect_profile):
-                            save_path = '{}/{}.{}'.format(path,id,ext)
-                            with open(save_path, 'wb') as f:  
-                                f.write(r.content)
\ No newline at end of file
+            self.hashes.save()
+
+        print(' ...saved {} of {} new files'.format(sum(saved),len(downloads)))
\ No newline at end of file
@@ -0,0 +1,72 @@
+### ASSIGNMENT OBJECTS ###
+from common import *
+from collections import deque
+
+class Auction:
+    # sparse auction solver for assigning rows (pictures) to columns (positions) at least total cost
+    # costs: (R,k) cost of each row at each of its candidate columns, inf for padding
+    # candidates: (R,k) column index of each candidate, -1 for padding
+    # rows bid for their best candidate and raise its price until every row holds one column
+    # eps shrinks over a few phases so early rounds settle quickly and later rounds refine
+    def __init__(self,costs,candidates,n_columns):
+        self.costs = numpy.asarray(costs,dtype=float)
+        self.candidates = numpy.asarray(candidates,dtype=int)
+        self.n_rows = self.costs.shape[0]
+        self.n_columns = n_columns
+        self.prices = numpy.zeros(n_columns)
+
+        finite = self.costs[numpy.isfinite(self.costs)]
+        spread = finite.max() - finite.min() if finite.size else 0
+        self.spread = spread if spread > 0 else 1
+
+    def solve(self,eps_scale=4,max_bids=None):
+        # return column for each row, -1 for rows that could not be placed among their candidates
+        eps_end = self.spread/(eps_scale*(self.n_rows+1))
+        eps = max(eps_end,self.spread/eps_scale)
+        bids_per_phase = max_bids if max_bids else 50*self.n_rows
+
+        while True:
+            assigned = self._bid(eps,bids_per_phase)
+            if eps <= eps_end:
+                break
+            eps = max(eps_end,eps/eps_scale)
+
+        return assigned
+
+    def _bid(self,eps,max_bids):
+        # one phase of bidding at a fixed eps, keeping prices from the last phase
+        # a row gives up once its best candidate is priced far beyond the cost spread
+        assigned = -numpy.ones(self.n_rows,dtype=int)
+        owners = -numpy.ones(self.n_columns,dtype=int)
+        give_up = 10*self.spread
+        single = self.candidates.shape[1] == 1
+
+        queue = deque(range(self.n_rows))
+        bids = 0
+        while (len(queue) > 0) & (bids < max_bids):
+            row = queue.popleft()
+            columns = self.candidates[row]
+            values = -self.costs[row] - self.prices[columns]
+            best = values.argmax()
+            value_1 = values[best]
+            if value_1 < -give_up:
+                continue
+
+            if single:
+                value_2 = -numpy.inf
+            else:
+                values[best] = -numpy.inf
+                value_2 = values.max()
+            if value_2 == -numpy.inf:
+                value_2 = value_1 - self.spread
+
+            column = columns[best]
+            self.prices[column] += value_1 - value_2 + eps
+            if owners[column] >= 0:
+                assigned[owners[column]] = -1
+                queue.append(owners[column])
+            owners[column] = row
+            assigned[row] = column
+            bids += 1
+
+        return assigned
@@ -6,13 +6,39 @@ import colorsys
 
 class Color:    
     # tuple of RGB
+    # colors are made often, so attributes are slotted and HSV is found when first needed
+    # Color.lookup shares one color for each RGB
+    __slots__ = ('red','green','blue','rgb','_hsv','_angle')
+    interned = {}
+
     def __init__(self,red,green,blue):
         self.red = red
         self.green = green
         self.blue = blue
         self.rgb = (self.red,self.green,self.blue)
-        self.hsv = colorsys.rgb_to_hsv(self.red,self.green,self.blue)
-        self.angle = CoordinateSystem.angle_simplified(self.hsv[0] * 2*math.pi)
+        self._hsv = None
+        self._angle = None
+
+    def lookup(red,green,blue):
+        # shared color for an RGB, made once
+        rgb = (red,green,blue)
+        color = Color.interned.get(rgb)
+        if color is None:
+            color = Color(red,green,blue)
+            Color.interned[rgb] = color
+        return color
+
+    @property
+    def hsv(self):
+        if self._hsv is None:
+            self._hsv = colorsys.rgb_to_hsv(self.red,self.green,self.blue)
+        return self._hsv
+
+    @property
+    def angle(self):
+        if self._angle is None:
+            self._angle = CoordinateSystem.angle_simplified(self.hsv[0] * 2*math.pi)
+        return self._angle
 
     def __repr__(self):
         string = 'R{:03}|G{:03}|B{:03}'.format(self.red,self.green,self.blue)
@@ -68,4 +94,143 @@ class Color:
 
         primary_color = Rainbow.get_rgb(primary)
 
-        return primary_color
\ No newline at end of file
+        return primary_color
+
+class ColorTable:
+    # shared Colors for every rounded color, as from Color.nearest_color, with HSV and angle filled in
+    # a color's row is found from its rounded channels
+    tables = {}
+
+    def __init__(self,threshold=16):
+        self.threshold = threshold
+        self.levels = numpy.unique((numpy.round(numpy.arange(256)/threshold)*threshold).astype(int))
+        self.rgb = numpy.stack(numpy.meshgrid(self.levels,self.levels,self.levels,indexing='ij'),axis=-1).reshape(-1,3)
+
+        self.colors = []
+        for red,green,blue in self.rgb.tolist():
+            color = Color.lookup(red,green,blue)
+            color.angle # fill in HSV and angle
+            self.colors.append(color)
+
+    def get(threshold=16):
+        # table for a rounding threshold, built once
+        if threshold not in ColorTable.tables:
+            ColorTable.tables[threshold] = ColorTable(threshold)
+        return ColorTable.tables[threshold]
+
+    def index(self,rgb):
+        # rows for an (N,3) array of rounded colors
+        levels = numpy.asarray(rgb)//self.threshold
+        n = len(self.levels)
+        return (levels[...,0]*n + levels[...,1])*n + levels[...,2]
+
+class Palette:
+    # prominent, secondary and greyscale colors for many images in one pass
+    # follows Pixelation: pixels are rounded to buckets and split into dark, grey and vibrant by their unrounded color,
+    # darks and greys replace vibrant counts for shared buckets when they are let in,
+    # and buckets rank by count with ties going to the bucket seen first
+    # pixel_counts: (count,(red,green,blue)) of each image, as from Image.getcolors
+    stages = 2**27 # room for a packed bucket key
+
+    def __init__(self,pixel_counts,grey_pct=100,dark_pct=100,
+                 grey_threshold=16,dark_threshold=100,round_threshold=16,secondary_threshold=256):
+        self.n_images = len(pixel_counts)
+        self.table = ColorTable.get(round_threshold)
+        lengths = [len(counts) for counts in pixel_counts]
+        image = numpy.repeat(numpy.arange(self.n_images),lengths)
+        freq = numpy.array([count for counts in pixel_counts for count,_ in counts],dtype=float)
+        rgb = numpy.array([pixel[:3] for counts in pixel_counts for _,pixel in counts],dtype=float).reshape(-1,3)
+        size = numpy.bincount(image,weights=freq,minlength=self.n_images)
+
+        # bucket and categorize each color
+        rounded,category = Palette.categorize(rgb,grey_threshold=grey_threshold,dark_threshold=dark_threshold,
+                                              round_threshold=round_threshold)
+
+        # count each bucket of each image by category, keeping where it first appears
+        key = (rounded[:,0]*512 + rounded[:,1])*512 + rounded[:,2]
+        buckets,pair = numpy.unique(image*self.stages + key,return_inverse=True)
+        pair = pair.reshape(-1)
+        n_pairs = len(buckets)
+        self.bucket_image = buckets // self.stages
+        bucket_key = buckets % self.stages
+        self.bucket_rgb = numpy.stack([bucket_key//512**2,(bucket_key//512)%512,bucket_key%512],axis=1)
+
+        order = numpy.arange(len(pair))
+        has,counts,firsts = [],[],[]
+        for c in range(3):
+            mask = category == c
+            counts.append(numpy.bincount(pair[mask],weights=freq[mask],minlength=n_pairs))
+            has.append(numpy.bincount(pair[mask],minlength=n_pairs) > 0)
+            first = numpy.full(n_pairs,len(pair))
+            numpy.minimum.at(first,pair[mask],order[mask])
+            firsts.append(first)
+        has_dark,has_grey,has_vibrant = has
+        count_dark,count_grey,count_vibrant = counts
+        first_dark,first_grey,first_vibrant = firsts
+
+        # let in darks, then greys, when there are no vibrants or too many darks
+        # (the grey test looks at darks too, as in Pixelation)
+        dark = category == 0
+        dark_total = numpy.bincount(image[dark],weights=freq[dark],minlength=self.n_images)
+        n_vibrant = numpy.bincount(self.bucket_image[has_vibrant],minlength=self.n_images)
+        add_dark = ((n_vibrant == 0) | (dark_total > dark_pct*size))[self.bucket_image]
+        n_added = numpy.bincount(self.bucket_image[has_vibrant | (add_dark & has_dark)],minlength=self.n_images)
+        add_grey = ((n_added == 0) | (dark_total > grey_pct*size))[self.bucket_image]
+
+        # vibrant ranking, with darks and greys written over vibrant counts and added after vibrants
+        dark_in = add_dark & has_dark
+        grey_in = add_grey & has_grey
+        vibrant_in = has_vibrant | dark_in | grey_in
+        value = numpy.where(grey_in,count_grey,numpy.where(dark_in,count_dark,count_vibrant))
+        stage = numpy.where(has_vibrant,0,numpy.where(dark_in,1,2))
+        first = numpy.where(has_vibrant,first_vibrant,numpy.where(dark_in,first_dark,first_grey))
+        self.prominence = self._rank(vibrant_in,value,stage,first)
+
+        # dull ranking, with all darks and greys written over
+        value = numpy.where(has_grey,count_grey,numpy.where(has_dark,count_dark,count_vibrant))
+        stage = numpy.select([has_vibrant,dark_in,grey_in,has_dark],[0,1,2,3],4)
+        first = numpy.select([has_vibrant,dark_in,grey_in,has_dark],[first_vibrant,first_dark,first_grey,first_dark],first_grey)
+        self.prominence_dull = self._rank(numpy.ones(n_pairs,dtype=bool),value,stage,first)
+
+        self._pick(secondary_threshold)
+
+    def _rank(self,included,value,stage,first):
+        # buckets of each image from most to least prominent, grouped by image
+        buckets = numpy.where(included)[0]
+        ranked = buckets[numpy.lexsort((first[buckets],stage[buckets],-value[buckets],self.bucket_image[buckets]))]
+        return ranked
+
+    def _pick(self,threshold):
+        # most prominent vibrant and dull colors, and the first vibrant color far enough from the most prominent
+        images = self.bucket_image[self.prominence]
+        starts = numpy.searchsorted(images,numpy.arange(self.n_images))
+        top = self.prominence[starts]
+        dull_images = self.bucket_image[self.prominence_dull]
+        dull = self.prominence_dull[numpy.searchsorted(dull_images,numpy.arange(self.n_images))]
+
+        # same weighting and scaling as Color.difference
+        deltas = self.bucket_rgb[self.prominence] - self.bucket_rgb[top][images]
+        distance = numpy.sqrt(2*deltas[:,0]**2 + 4*deltas[:,1]**2 + 3*deltas[:,2]**2)/math.sqrt(2*255**2 + 4*255**2 + 3*255**2)
+        far = (distance >= threshold) & (numpy.arange(len(images)) > starts[images])
+        first_far = numpy.full(self.n_images,len(images))
+        numpy.minimum.at(first_far,images[far],numpy.where(far)[0])
+        found = first_far < len(images)
+        secondary = dull.copy()
+        secondary[found] = self.prominence[first_far[found]]
+
+        self.picks = numpy.stack([self.bucket_rgb[top],self.bucket_rgb[secondary],self.bucket_rgb[dull]],axis=1)
+
+    def categorize(rgb,grey_threshold=16,dark_threshold=100,round_threshold=16):
+        # rounded buckets and categories of an (N,3) array of colors, 0 dark, 1 grey or 2 vibrant
+        # as Color.nearest_color, Color.is_dark and Color.is_grey, with darks and greys judged on the unrounded color
+        rgb = numpy.asarray(rgb,dtype=float).reshape(-1,3)
+        rounded = (numpy.round(rgb/round_threshold)*round_threshold).astype(int)
+        dark = rgb.max(1) < dark_threshold
+        greyness = numpy.sqrt((rgb[:,0]-rgb[:,1])**2 + (rgb[:,0]-rgb[:,2])**2 + (rgb[:,1]-rgb[:,2])**2)
+        grey = (~dark) & (greyness < grey_threshold*3)
+        category = numpy.where(dark,0,numpy.where(grey,1,2))
+        return rounded,category
+
+    def get_colors(self,n):
+        # prominent, secondary and greyscale colors of the nth image
+        return [self.table.colors[row] for row in self.table.index(self.picks[n]).tolist()]
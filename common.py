@@ -1,17 +1,51 @@
 ### METHODS USED ACROSS MODULES ###
 import numpy
 import os
+import concurrent.futures
 
 class Common:
     # methods used throughout app
-    def find_files(folder,extensions=None):
+    def find_files(folder,extensions=None,workers=1):
         # find files in a subfolder with an extension
-        folders = [fold[0] for fold in os.walk(folder)]
-        files = [fl+'/'+fn for fl in folders for fn in os.listdir(fl)]
-        if extensions:
-            files = [fn for fn in files if Common.extension_in(fn,extensions)]
+        files = [fn for fn,stat in Common.scan_files(folder,extensions,workers)]
         return files
 
+    def scan_files(folder,extensions=None,workers=1):
+        # yield (path,stat) for files in a folder and its subfolders that end in an extension
+        # each folder is read once, files in a folder come before its subfolders
+        # with more than one worker, the folders of each level are read at the same time in threads
+        suffixes = tuple('.'+ext.lower() for ext in extensions) if extensions else None
+        if workers > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                level = [folder]
+                while len(level) > 0:
+                    scanned = list(executor.map(lambda fl: Common._scan_folder(fl,suffixes),level))
+                    level = [sub for files,subfolders in scanned for sub in subfolders]
+                    for files,subfolders in scanned:
+                        yield from files
+        else:
+            folders = [folder]
+            while len(folders) > 0:
+                files,subfolders = Common._scan_folder(folders.pop(),suffixes)
+                folders.extend(reversed(subfolders))
+                yield from files
+
+    def _scan_folder(folder,suffixes=None):
+        # files with their stats and the subfolders of one folder, without following linked folders
+        files = []
+        subfolders = []
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    path = folder+'/'+entry.name
+                    if entry.is_dir(follow_symlinks=False):
+                        subfolders.append(path)
+                    elif entry.is_file() and ((suffixes is None) or entry.name.lower().endswith(suffixes)):
+                        files.append((path,entry.stat()))
+        except OSError:
+            pass
+        return files,subfolders
+
     def extension_in(filename,extensions):
         # see if an extension is in a file name
         ext_in = any('.'+ext.lower() in filename.lower() for ext in extensions)
@@ -2,7 +2,10 @@
 from common import *
 from media import *
 from plotting import *
+from scoring import *
+from assignment import *
 import itertools
+import heapq
 from PIL import ImageDraw,ImageFont
 import copy
 
@@ -21,6 +24,115 @@ class Cell:
         # add positions of cells that border this cells
         self.neighbors = CSM.neighbors(self.position)
 
+class OpenPositions:
+    # bucketed index of open grid positions for nearest-open-position lookups
+    # positions are grouped into square buckets of matrix coordinates and searched ring by ring
+    # ties in distance go to the lowest position, as with sorted open positions
+    def __init__(self,coordinate_system:CoordinateSystem,positions,bucket=8):
+        self.CS = coordinate_system
+        self.bucket = bucket
+        self.buckets = {}
+        self.open = set()
+        for position in positions:
+            self.open.add(position)
+            self.buckets.setdefault(self._bucket(position),set()).add(position)
+
+        # lowest position still open is found from a heap with lazy removal
+        self.heap = sorted(self.open)
+
+        # smallest distance per unit of coordinate offset, used to stop the ring search
+        self.scale = math.sqrt(3)/2 if self.CS.lattice == 'hexagonal' else 1
+
+        if len(self.buckets):
+            keys = list(self.buckets.keys())
+            self.limits = (min(k[0] for k in keys),max(k[0] for k in keys),
+                           min(k[1] for k in keys),max(k[1] for k in keys))
+
+    def _bucket(self,position):
+        # bucket containing a position
+        return (math.floor(position[0]/self.bucket),math.floor(position[1]/self.bucket))
+
+    def size(self):
+        # number of open positions
+        return len(self.open)
+
+    def remove(self,position):
+        # close a position
+        if position in self.open:
+            self.open.remove(position)
+            key = self._bucket(position)
+            self.buckets[key].discard(position)
+            if len(self.buckets[key]) == 0:
+                self.buckets.pop(key)
+
+    def first(self):
+        # lowest open position
+        while len(self.heap) and (self.heap[0] not in self.open):
+            heapq.heappop(self.heap)
+        position = self.heap[0] if len(self.heap) else None
+        return position
+
+    def nearest(self,target):
+        # open position closest to a target
+        if len(self.open) < 4*self.bucket:
+            candidates = [(self.CS.distance(position,target),position) for position in self.open]
+            return min(candidates)[1] if len(candidates) else None
+
+        bi,bj = self._bucket(target)
+        i_min,i_max,j_min,j_max = self.limits
+        rings = max(abs(bi-i_min),abs(bi-i_max),abs(bj-j_min),abs(bj-j_max))
+        best = None
+        for r in range(rings+1):
+            # anything in this ring or beyond is at least (r-1) buckets away
+            if (best is not None) and (best[0] < self.scale*(r-1)*self.bucket):
+                break
+            for key in self._ring(bi,bj,r):
+                for position in self.buckets.get(key,()):
+                    candidate = (self.CS.distance(position,target),position)
+                    if (best is None) or (candidate < best):
+                        best = candidate
+
+        position = best[1] if best is not None else None
+        return position
+
+    def nearest_k(self,target,k):
+        # up to k open positions closest to a target, closest first
+        # distances within each ring are found together, as in CoordinateSystem.distance
+        bi,bj = self._bucket(target)
+        i_min,i_max,j_min,j_max = self.limits
+        rings = max(abs(bi-i_min),abs(bi-i_max),abs(bj-j_min),abs(bj-j_max))
+        positions = []
+        distances = numpy.zeros(0)
+        for r in range(rings+1):
+            # anything in this ring or beyond is at least (r-1) buckets away
+            if (len(positions) >= k) and (numpy.partition(distances,k-1)[k-1] < self.scale*(r-1)*self.bucket):
+                break
+            ring = [position for key in self._ring(bi,bj,r) for position in self.buckets.get(key,())]
+            if len(ring):
+                positions.extend(ring)
+                distances = numpy.concatenate([distances,self._distances(ring,target)])
+
+        order = numpy.lexsort((numpy.array(positions).reshape(-1,2)[:,1],numpy.array(positions).reshape(-1,2)[:,0],distances))[:k]
+        return [positions[n] for n in order]
+
+    def _distances(self,positions,target):
+        # distances from positions to a target, as in CoordinateSystem.distance
+        xy = numpy.array(positions,dtype=float) - numpy.array(target,dtype=float)
+        if self.CS.lattice == 'hexagonal':
+            distances = numpy.sqrt((xy**2).sum(1) + xy.sum(1)**2)/math.sqrt(2)
+        else:
+            distances = numpy.sqrt((xy**2).sum(1))
+        return distances
+
+    def _ring(self,bi,bj,r):
+        # bucket keys at Chebyshev distance r
+        if r == 0:
+            keys = [(bi,bj)]
+        else:
+            keys = [(bi+di,bj+dj) for di in (-r,r) for dj in range(-r,r+1)] + \
+                   [(bi+di,bj+dj) for di in range(-r+1,r) for dj in (-r,r)]
+        return keys
+
 class Grid:
     # collection of cells with bridges and tautness
     # tautness: the sum of strengths across all bridges
@@ -34,7 +146,7 @@ class Grid:
         self.dimensions = (height,width)
         self.size = height*width
         self.cells = {}
-        self.blocked = []
+        self.blocked = set()
         self.center = None
         self.center_size = 0
 
@@ -48,6 +160,16 @@ class Grid:
         self.positions = self.CSM.get_positions()
 
         self.max_distance = self.CS.distance((self.height,self.width))
+
+        # running sum of cell strengths so tautness does not need a full pass
+        self.strength_total = 0
+        self.safe_count = 0
+
+        # array-backed strength calculations, built on a full scoring pass
+        self.scorer = None
+
+        # index of open positions, built on the first placement
+        self.openings = None
         
         for position in self.positions:
             self.cells[position] = None
@@ -58,7 +180,7 @@ class Grid:
             if self.cell_filled(p):
                 string += '{}'.format(self.cells[p].picture.color)
             else:
-                string += '{}'.format(Color(0,0,0))
+                string += '{}'.format(Color.lookup(0,0,0))
             string += ' || '
         string += '\n'
         return string[:-1]
@@ -80,35 +202,37 @@ class Grid:
         return filled
 
     def _get_order(self,corner=None):
-        # return list of possible cells to insert based on target
-        closed_positions = [cell for cell in self.cells if self.cell_filled(cell)]
-        open_positions = sorted([(i,j) for i,j in self.positions if (i,j) not in closed_positions])
+        # return the closest open position to a target, or the first open position
+        if self.openings is None:
+            self.openings = OpenPositions(self.CS,[position for position in self.positions if not self.cell_filled(position)])
+
         if corner:
             R,theta = corner
-            x,y = self.CS.from_polar(R,theta)
             target = self.CSM.polar_to_matrix(R,theta)
-            distances = [self.CS.distance(position,target) for position in open_positions]
-            open_positions = Common.sort_by_list(open_positions,distances)
+            position = self.openings.nearest(target)
         else:
             target = None
+            position = self.openings.first()
 
-        if len(open_positions)>0:
-            position = open_positions[0]
-        else:
-            position = None
         return position,target
 
     def add_cell(self,picture:Picture,corner=None):
         # add a picture to a cell or the closest open position
         position,target = self._get_order(corner)      
         if position:
-            x,y = position
+            self.place_cell(picture,position,target)
 
-            cell = Cell(picture,(x,y))
-            self.cells[(x,y)] = cell
-      
-            self.cells[(x,y)].add_neighbors(self.height,self.width,self.CSM)
-            self.cells[(x,y)].picture.target = target
+    def place_cell(self,picture:Picture,position,target=None):
+        # put a picture in a specific open position
+        x,y = position
+        if self.openings is not None:
+            self.openings.remove(position)
+
+        cell = Cell(picture,(x,y))
+        self.cells[(x,y)] = cell
+  
+        self.cells[(x,y)].add_neighbors(self.height,self.width,self.CSM)
+        self.cells[(x,y)].picture.target = target
 
     def add_center(self,center_size=1,x_loc=0.5,y_loc=0.5):
         # block off space in the center of the grid for a larger central image
@@ -130,22 +254,81 @@ class Grid:
                     neighbors.extend(self.CSM.neighbors(b,half_width=self.CS.lattice=='hexagonal'))
                 blocked_ring.extend(neighbor for neighbor in neighbors if neighbor not in blocked_ring)
               
-            self.blocked.extend(blocked_ring)
+            self.blocked.update(blocked_ring)
             
-    def add_from_gallery(self,gallery:Gallery):
+    def add_from_gallery(self,gallery:Gallery,refine=False):
         # add pictures from a gallery in a specific order
+        # refine: follow the greedy placement with local rounds of moves among nearby cells
         self.angle = gallery.angle
         if gallery.center:
             center_xy = self.center
             self.cells[center_xy] = Cell(gallery.center,center_xy)
 
-        for picture in gallery.pictures:
-            self.add_cell(picture,gallery.corners.get(picture.id))
+        if refine:
+            self._refine_from_gallery(gallery)
+        else:
+            for picture in gallery.pictures:
+                self.add_cell(picture,gallery.corners.get(picture.id))
 
         self.add_cell_strengths()
 
         return
 
+    def _refine_from_gallery(self,gallery:Gallery,k=16,rounds=10):
+        # place greedily, then improve with rounds of local moves, each solved as a sparse assignment
+        # the cost of a picture at a position is the strength it would have there against the pictures around it now,
+        # so color difference counts along with distance, angle, darkness and frames
+        # candidates are the positions nearest a picture's target and nearest the position it holds
+        # this is a local refinement, not a global optimum: costs change as neighbors move,
+        # and a round is kept only if it makes the grid stronger, so the result is never weaker than the greedy placement
+        for picture in gallery.pictures:
+            self.add_cell(picture,gallery.corners.get(picture.id))
+
+        self.add_cell_strengths()
+        scorer = self.scorer
+        if scorer.size < 2:
+            return
+        index = OpenPositions(self.CS,scorer.positions,bucket=4)
+        near_target = {} # nearest positions by picture target, kept across rounds
+        near_position = {} # nearest positions by held position, kept across rounds
+
+        for r in range(rounds):
+            total_0 = self.strength_total
+            pictures = [self.cells[position].picture for position in scorer.positions]
+
+            # nearby candidate slots for each picture, padded with -1
+            candidates = -numpy.ones((scorer.size,k+1),dtype=int)
+            for slot,(position,picture) in enumerate(zip(scorer.positions,pictures)):
+                target = picture.target if picture.target is not None else position
+                if target not in near_target:
+                    near_target[target] = index.nearest_k(target,k//2+1)
+                if position not in near_position:
+                    near_position[position] = index.nearest_k(position,k-k//2+1)
+                nearby = near_target[target] + near_position[position]
+                nearby = [scorer.index[near] for near in dict.fromkeys(nearby) if near != position][:k]
+                candidates[slot,:len(nearby)] = nearby
+                candidates[slot,k] = slot
+
+            costs = scorer.estimates(scorer.pictures,numpy.maximum(candidates,0),shared=True)
+            costs[candidates < 0] = numpy.inf
+            assigned = Auction(costs,candidates,scorer.size).solve()
+
+            # pictures that could not be placed among their candidates take the slots left over
+            free = iter(sorted(set(range(scorer.size)) - set(assigned.tolist())))
+            assigned = [slot if slot >= 0 else next(free) for slot in assigned.tolist()]
+
+            for picture,slot in zip(pictures,assigned):
+                self.cells[scorer.positions[slot]].picture = picture
+            self.add_cell_strengths()
+            scorer = self.scorer
+
+            if self.strength_total >= total_0:
+                # step back to the last round
+                for position,picture in zip(scorer.positions,pictures):
+                    self.cells[position].picture = picture
+                self.add_cell_strengths()
+                break
+
     def send_to_gallery(self):
         # put all pictures back into a gallery
         if len(self.blocked):
@@ -161,7 +344,7 @@ class Grid:
         gallery = Gallery(pictures,randomize=False,center=center)
         return gallery
 
-    def reseed(self):
+    def reseed(self,refine=False):
         # organize pictures by a color mapping
         gallery = self.send_to_gallery()
         
@@ -171,15 +354,111 @@ class Grid:
         grid.blocked = self.blocked 
         grid.center = self.center
         grid.center_size = self.center_size
-        grid.add_from_gallery(gallery)
+        grid.add_from_gallery(gallery,refine=refine)
         return grid
 
-    def worst_pairings(self):
-        # list of cells pairings by order of strengths
-        combos = list(itertools.combinations(range(self.size - len(self.blocked)),2))
-        products = [(i+1)*(j+1) for i,j in combos]
-        pairings = Common.sort_by_list(combos,products)
-        return pairings
+    def save_layout(self,path,gallery:Gallery=None):
+        # write the shape of the grid and the position of each picture to a json file
+        # pictures of the gallery that did not fit are listed so an update can tell them from new ones
+        pictures = {cell.picture.id:list(position) for position,cell in self.cells.items() if cell is not None}
+        unused = [picture.id for picture in gallery.pictures if picture.id not in pictures] if gallery is not None else []
+        layout = {'lattice':self.CS.lattice,'height':self.height,'width':self.width,'width2':self.width2,
+                  'center':list(self.center) if self.center is not None else None,'center_size':self.center_size,
+                  'angle':self.angle,'pictures':pictures,'unused':unused}
+
+        temp_path = path + '.tmp'
+        with open(temp_path,'w') as f:
+            json.dump(layout,f)
+        os.replace(temp_path,path)
+
+    def load_layout(path):
+        # read a layout written by save_layout, or None if there isn't one
+        layout = None
+        if (path is not None) and os.path.isfile(path):
+            try:
+                with open(path,'r') as f:
+                    layout = json.load(f)
+                layout['pictures'] = {id:tuple(position) for id,position in layout['pictures'].items()}
+                if layout['center'] is not None:
+                    layout['center'] = tuple(layout['center'])
+            except (OSError,ValueError,KeyError):
+                layout = None
+        return layout
+
+    def fits_layout(self,layout):
+        # see if a layout was saved from a grid of the same shape
+        shape = (self.CS.lattice,self.height,self.width,self.width2,self.center,self.center_size)
+        fits = (layout is not None) and \
+               ((layout['lattice'],layout['height'],layout['width'],layout['width2'],layout['center'],layout['center_size']) == shape)
+        return fits
+
+    def update_from_gallery(self,gallery:Gallery,layout):
+        # put pictures of an ordered gallery back where a layout had them, and new pictures in the open positions
+        # within photos, stories and videos, new pictures come before kept pictures, which come before unused pictures,
+        # so only as many kept pictures as needed give up their places
+        # returns the positions that took a different picture
+        self.angle = gallery.angle
+        if gallery.center:
+            center_xy = self.center
+            self.cells[center_xy] = Cell(gallery.center,center_xy)
+
+        n_open = len([position for position in self.positions if not self.cell_filled(position)])
+        pictures = layout['pictures']
+        known = set(pictures) | set(layout['unused'])
+        ranks = [(gallery.category(picture),0 if picture.id not in known else 1 if picture.id in pictures else 2) \
+                 for picture in gallery.pictures]
+        shown = [gallery.pictures[i] for i in sorted(range(len(ranks)),key=ranks.__getitem__)][:n_open]
+
+        # kept pictures go back to their places
+        added = []
+        for picture in shown:
+            position = pictures.get(picture.id)
+            if (position in self.cells) and (not self.cell_filled(position)):
+                corner = gallery.corners.get(picture.id)
+                target = self.CSM.polar_to_matrix(*corner) if corner else None
+                self.place_cell(picture,position,target)
+            else:
+                added.append(picture)
+
+        # the rest take the open positions nearest their colors
+        changed = []
+        for picture in added:
+            position,target = self._get_order(gallery.corners.get(picture.id))
+            if position:
+                self.place_cell(picture,position,target)
+                changed.append(position)
+
+        self.add_cell_strengths()
+
+        return changed
+
+    def neighborhood(self,positions,radius=2):
+        # filled positions within a number of steps of any of the positions
+        region = set(positions)
+        ring = set(positions)
+        for r in range(radius):
+            ring = {neighbor for position in ring for neighbor in self.cells[position].neighbors \
+                    if (neighbor not in self.blocked) and (self.cells.get(neighbor) is not None) and (neighbor not in region)}
+            region.update(ring)
+        return sorted(region)
+
+    def worst_pairings(self,n=None):
+        # yield cell pairings by order of strengths, ranked by (i+1)*(j+1)
+        # pairs are streamed from a heap holding one frontier pair per row
+        # so memory grows with the rows reached rather than with n^2
+        # n: number of cells ranked, all scored cells if not given
+        if n is None:
+            n = self.safe_count
+        if n > 1:
+            frontier = [(2,0,1)]
+            while len(frontier):
+                product,i,j = heapq.heappop(frontier)
+                yield (i,j)
+                if j+1 < n:
+                    heapq.heappush(frontier,((i+1)*(j+2),i,j+1))
+                # open the next row once this row has started
+                if (j == i+1) & (j+1 < n):
+                    heapq.heappush(frontier,((j+1)*(j+2),j,j+1))
 
     def check_swap(self,cell1,cell2,threshold=0):
         # check to see if a swap is worthwhile
@@ -203,6 +482,8 @@ class Grid:
         temp_picture = self.cells[cell1].picture
         self.cells[cell1].picture = self.cells[cell2].picture
         self.cells[cell2].picture = temp_picture
+        if self.scorer is not None:
+            self.scorer.swap(cell1,cell2)
         region = []
         for cell in cell1,cell2:
             neighbors = [self.cells[neighbor] for neighbor in self.cells[cell].neighbors if neighbor not in self.blocked]
@@ -214,88 +495,31 @@ class Grid:
         distance = self.cells[cell1].picture.difference(self.cells[cell2].picture)
         return distance
 
-    def add_cell_strength(self,cell):
-        # recalculate strength metric based on bridges
-        x0,y0 = cell.position
-        neighbors = [neighbor for neighbor in cell.neighbors if neighbor not in self.blocked]
-
-        # account for placement distance
-        if (self.weights.get('distance') > 0):
-            distance_weight = self.weights['distance']
-            if cell.picture.target is not None:
-                R,theta = cell.picture.target
-                x1,y1 = self.CSM.polar_to_matrix(R,theta)
-
-                distance_strength = self.CS.distance(cell.position,cell.picture.target)/self.max_distance
-
-            else:
-                distance_strength = 0.5
-        else:
-            distance_weight = 0
-            distance_strength = 0
-
-        # account for placement angle
-        if self.weights.get('angle') > 0:
-            if cell.picture.angle is not None:
-                angle = cell.picture.angle
-                angle_weight = self.weights['angle']
-                current_angle = math.atan2(y0-self.width/2,x0-self.height/2)
-                angle_diff = CoordinateSystem.angle_difference(current_angle,angle+self.angle)
-                angle_strength = angle_weight * angle_diff/(2*math.pi)
-            else:
-                angle_strength = 0.5
-        else:
-            angle_weight = 0
-            angle_strength = 0
-
-        # account for darkness
-        if self.weights.get('dark') > 0:
-            dark_weight = self.weights['dark']
-            if cell.picture.dark:
-                distance_to_edge = self.CSM.path_finder(cell.position,to_edge=True,normalize=True)
-            else:
-                distance_to_edge = 0
-            dark_strength = dark_weight * distance_to_edge
-        else:
-            dark_weight = 0
-            dark_strength = 0
-
-        # account for video frames being next to each other
-        if self.weights.get('frame') > 0:
-            frame_weight = self.weights['frame']
-            id = cell.picture.id
-            if Common.extension_in(id,['mp4']) & (len(neighbors)>0):
-                frame_id = id[:id.rfind('_')].lower()
-                frame_strength = sum((frame_id in self.cells[neighbor].picture.id.lower() for neighbor in neighbors))/len(neighbors)
-            else:
-                frame_strength = 0
+    def add_cell_strengths(self,region=None):
+        # update all cell strengths, which are defined by the strength array
+        # a full pass rebuilds the strength array and scores every cell in one batch
+        # a region is scored against the existing array, after a full pass builds it if there is none yet
+        full = (not region) or (self.scorer is None)
+        if full:
+            self.scorer = StrengthArray(self)
+            cells = self.scorer.positions
         else:
-            frame_weight = 0
-            frame_strength = 0
-
-        # account for color difference
-        difference_weight = 1 - sum([distance_weight,angle_weight,dark_weight,frame_weight])
+            cells = list({cell.position for cell in region})
 
-        if len(neighbors):
-            differences = [(cell.picture.difference(self.cells[neighbor].picture))**2 for neighbor in neighbors]
-            difference_strength = difference_weight * (sum(differences) / len(neighbors))
-        else:
-            difference_strength = 0
-        
-        self.cells[(x0,y0)].strength = difference_strength + distance_strength + angle_strength + dark_strength + frame_strength
+        strengths = self.scorer.strengths(cells).tolist()
+        for cell,strength in zip(cells,strengths):
+            self.strength_total += strength - self.cells[cell].strength
+            self.cells[cell].strength = strength
 
-    def add_cell_strengths(self,region=None):
-        # update all cell strengths
-        if region:
-            cells = [cell.position for cell in region]
-        else:
-            cells = [cell for cell in self.cells if cell not in self.blocked]
-        for cell in cells:
-            self.add_cell_strength(self.cells[cell])
+        # resum after a full pass to clear any drift from incremental updates
+        if full:
+            self.strength_total = sum(self.cells[cell].strength for cell in cells)
+            self.safe_count = len(cells)
        
-    def worst_cells(self):
-        # list cells in order of strength
-        positions = self._safe_cells()
+    def worst_cells(self,positions=None):
+        # list cells in order of strength, of all scored cells or only some positions
+        if positions is None:
+            positions = self._safe_cells()
         strengths = [self.cells[c].strength for c in positions]
         worst = Common.sort_by_list(positions,strengths,reverse=True)
         worst = [tuple(w) for w in worst]
@@ -306,21 +530,117 @@ class Grid:
         # -1 = all cells different from neighbors
         # 0 = average cells half a color different
         # 1 = all cells same as neighbors
-        safe_cells = self._safe_cells()
-        taut_exp = sum([self.cells[cell].strength for cell in safe_cells])/len(safe_cells)
-        taut = 1 - 2*taut_exp
+        # uses the running total so a swap check does not rescan the grid
+        # a grid without scored cells has no strength either way
+        if self.safe_count == 0:
+            taut = 0
+        else:
+            taut_exp = self.strength_total/self.safe_count
+            taut = 1 - 2*taut_exp
 
         return taut
 
     def save_output(self,dimension=50,library=None,
                     secondary_scale=None,vibrant=True,border=0,border_color=(0,0,0),
-                    print_strength=False,capsize=10000):
+                    print_strength=False,capsize=10000,tiles:TileCache=None):
         # create image file of cells
         # if library is not given, only print colors
+        # tiles: cache of cropped pictures from earlier renders
 
         # extend grid and add border color
         border = min(border,dimension)
+        image_width,image_height = self._output_size(dimension,border)
+
+        # prevent program from crashing by capping image size
+        image_width = round(min(capsize,image_width))
+        image_height = round(min(capsize,image_height))
+
+        grid_image = Image.new('RGB',(image_width,image_height),border_color)
+
+        # hexagons are pasted through a mask shared by cells of the same size
+        for position,center,paste_TL in self._output_layout(dimension,border):
+            paste_picture,paste_mask = self._output_picture(position,center,dimension,border,library=library,tiles=tiles,
+                                                            secondary_scale=secondary_scale,vibrant=vibrant,
+                                                            print_strength=print_strength)
+            paste_box = (paste_TL[0],paste_TL[1],
+                         paste_TL[0]+paste_picture.height,paste_TL[1]+paste_picture.width)
+
+            grid_image.paste(paste_picture,paste_box,paste_mask)
 
+        return grid_image
+
+    def save_tiles(self,folder,name,dimension=50,library=None,vibrant=True,border=0,border_color=(0,0,0),
+                   tile_size=256,extension='jpg',tiles:TileCache=None):
+        # write the grid as a Deep Zoom pyramid of tiles without drawing the whole image at once
+        # full size tiles are drawn a row at a time from only the cells that overlap them,
+        # and each smaller level is made from four tiles of the level above
+        # returns the path of the .dzi file that describes the pyramid
+        border = min(border,dimension)
+        width,height = [max(1,round(d)) for d in self._output_size(dimension,border)]
+        layout = self._output_layout(dimension,border)
+        levels = math.ceil(math.log2(max(width,height))) if max(width,height) > 1 else 0
+        files = '{}/{}_files'.format(folder,name)
+
+        # find which tiles each cell overlaps and the last tile that needs it
+        columns,rows = math.ceil(width/tile_size),math.ceil(height/tile_size)
+        overlaps = {}
+        last_use = {}
+        for n,(position,center,paste_TL) in enumerate(layout):
+            dim_mul = self.center_size if center else 1
+            reach = dimension*dim_mul + border*dim_mul + 1 # at least the size of the picture
+            col_range = range(max(0,paste_TL[0]//tile_size),min(columns,(paste_TL[0]+reach)//tile_size+1))
+            row_range = range(max(0,paste_TL[1]//tile_size),min(rows,(paste_TL[1]+reach)//tile_size+1))
+            for row in row_range:
+                for col in col_range:
+                    overlaps.setdefault((col,row),[]).append(n)
+                    last_use[n] = max(last_use.get(n,0),row*columns+col)
+
+        # draw the full size level, keeping a cell's picture only until its last tile
+        os.makedirs('{}/{}'.format(files,levels),exist_ok=True)
+        drawn = {}
+        for row in range(rows):
+            for col in range(columns):
+                x,y = col*tile_size,row*tile_size
+                tile = Image.new('RGB',(min(tile_size,width-x),min(tile_size,height-y)),border_color)
+                for n in overlaps.get((col,row),[]):
+                    position,center,paste_TL = layout[n]
+                    if n not in drawn:
+                        drawn[n] = self._output_picture(position,center,dimension,border,library=library,tiles=tiles,vibrant=vibrant)
+                    paste_picture,paste_mask = drawn[n]
+                    tile.paste(paste_picture,(paste_TL[0]-x,paste_TL[1]-y),paste_mask)
+                    if last_use[n] == row*columns+col:
+                        drawn.pop(n)
+                tile.save('{}/{}/{}_{}.{}'.format(files,levels,col,row,extension))
+
+        # halve each level into the next
+        level_width,level_height = width,height
+        for level in range(levels-1,-1,-1):
+            above = (level_width,level_height)
+            level_width,level_height = math.ceil(level_width/2),math.ceil(level_height/2)
+            os.makedirs('{}/{}'.format(files,level),exist_ok=True)
+            for row in range(math.ceil(level_height/tile_size)):
+                for col in range(math.ceil(level_width/tile_size)):
+                    x,y = 2*col*tile_size,2*row*tile_size
+                    w,h = min(2*tile_size,above[0]-x),min(2*tile_size,above[1]-y)
+                    merged = Image.new('RGB',(w,h),border_color)
+                    for dy in range(2):
+                        for dx in range(2):
+                            if (dx*tile_size < w) & (dy*tile_size < h):
+                                with Image.open('{}/{}/{}_{}.{}'.format(files,level+1,2*col+dx,2*row+dy,extension)) as child:
+                                    merged.paste(child,(dx*tile_size,dy*tile_size))
+                    tile = merged.resize((min(tile_size,level_width-col*tile_size),min(tile_size,level_height-row*tile_size)),RESAMPLE)
+                    tile.save('{}/{}/{}_{}.{}'.format(files,level,col,row,extension))
+
+        dzi = '{}/{}.dzi'.format(folder,name)
+        with open(dzi,'w') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{}" Overlap="0" Format="{}">'
+                    '<Size Width="{}" Height="{}"/></Image>\n'.format(tile_size,extension,width,height))
+
+        return dzi
+
+    def _output_size(self,dimension,border):
+        # width and height of the full image
         if self.CS.lattice == 'cartesian':
             image_width = (dimension + border)*self.width
             image_height = (dimension + border)*self.height
@@ -335,80 +655,31 @@ class Grid:
 
             image_height = dimension*height_adj + border*hex*self.height # borders between rows are small, overall height is adjusted because rows fit together
             image_width = dimension*(width_adj) + border*(width_max-height_even/2) # second row starts shifted by 1/4 border #width_max for width_adj
-        
-        # prevent program from crashing by capping image size
-        image_width = round(min(capsize,image_width))
-        image_height = round(min(capsize,image_height))
 
-        grid_image = Image.new('RGB',(image_width,image_height),border_color)
+        return image_width,image_height
 
+    def _output_layout(self,dimension,border):
+        # top left corner of each cell's picture in the full image, in drawing order
         if (self.center is not None) & (self.center not in self.positions):
             positions = [self.center] + self.positions
         else:
             positions = self.positions
 
+        layout = []
         for i,j in positions:
             if self.cells[(i,j)]:
-                picture = self.cells[(i,j)].picture
-
                 # expand the center image
                 center = (i,j) == self.center
-                if center:
-                    dim_mul = self.center_size
-                else:
-                    dim_mul = 1
-                        
-                paste_secondary = None
-                if library is None:
-                    if vibrant:
-                        color = picture.color
-                    else:
-                        color = picture.greyscale
-
-                    dimension_paste = int(dimension*dim_mul)
-                    paste_picture = Image.new('RGB',(dimension_paste,dimension_paste),color.rgb)
-                    
-                    if (secondary_scale is not None) & (picture.secondary is not None):
-                        secondary = picture.secondary
-                        dimension_2 = int(dimension*min(0.5,secondary_scale))
-                        dimension_2 = int(dimension*min(0.5,secondary_scale))
-                        paste_secondary = Image.new('RGB',(dimension_2,dimension_2),secondary.rgb)
-                        paste_picture.paste(paste_secondary,(int(dimension*0.5),int(dimension*0.5)))
-
-                    if print_strength:
-                        font_size = round(dimension/5)
-                        font = ImageFont.truetype('arial.ttf',font_size) ### LINK SOMEWHERE
-                        strength_text = '{:.03f}'.format(self.cells[(i,j)].strength)
-                        target_text = '{}'.format(self.cells[(i,j)].picture.target)
-                        rgb_text = '({},{},{})'.format(*self.cells[(i,j)].picture.color.rgb)
-
-                        texts = [strength_text,target_text,rgb_text]
-                        draw = ImageDraw.Draw(paste_picture)
-
-                        for text in texts:
-                            draw.text((0,texts.index(text)*(font_size+1)),text,(255,255,255),font=font)
-                        paste_picture = draw.im
-
-                else:
-                    paste_picture = library.get_photo(picture.id).image
-                    h,w = paste_picture.size
-                    if h != w:
-                        m = min(h,w)/2
-                        paste_picture = paste_picture.crop((int(h/2-m),int(w/2-m),int(h/2+m),int(w/2+m)))
-                    dim_resize = int(dimension*dim_mul + border*(dim_mul-1))
-                    paste_picture = paste_picture.resize((dim_resize,dim_resize),Image.ANTIALIAS)
 
                 if self.CS.lattice == 'cartesian':
-                    paste_mask = None
                     d_p = 0
                     i_p,j_p = i,j
-                    
+
                 elif self.CS.lattice == 'hexagonal':
-                    paste_picture = Shaper.shape(paste_picture,'hexagon',size=self.center_size//2+1 if center else 1)
-                    paste_mask = paste_picture
+                    hex,extra = self.CSM.scaling
                     d_p = (1-hex)*dimension
                     j_p,i_p = self.CS.to_rectangular((j,i))
-                
+
                 if center:
                     if self.CS.lattice == 'cartesian':
                         c_ex = 0
@@ -416,18 +687,65 @@ class Grid:
                         c_ex = 1/4 * (self.center_size//2)
                     move_i = self.CSM.convert_height(dimension*(self.center_size-1)/2) + border*(self.center_size-1)/2 + c_ex*dimension
                     move_j = self.CSM.convert_width(dimension*(self.center_size-1)/2) + border*(self.center_size-1)/2
-                    
+
                 else:
                     move_i,move_j = 0,0
 
                 paste_TL = (int(dimension*j_p + border*(j_p+0.5) - j_p*d_p - move_j),
                             int(dimension*i_p + border*(i_p+0.5) - i_p*d_p - move_i))
-                paste_box = (paste_TL[0],paste_TL[1],
-                             paste_TL[0]+paste_picture.height,paste_TL[1]+paste_picture.width)
+                layout.append(((i,j),center,paste_TL))
 
-                grid_image.paste(paste_picture,paste_box,paste_mask)
+        return layout
 
-        if self.CS.lattice == 'hexagonal':
-            grid_image = Shaper.blot(grid_image)
-        
-        return grid_image
\ No newline at end of file
+    def _output_picture(self,position,center,dimension,border,library=None,tiles:TileCache=None,
+                        secondary_scale=None,vibrant=True,print_strength=False):
+        # picture to paste for a cell and its mask
+        i,j = position
+        picture = self.cells[(i,j)].picture
+        dim_mul = self.center_size if center else 1
+
+        paste_secondary = None
+        if library is None:
+            if vibrant:
+                color = picture.color
+            else:
+                color = picture.greyscale
+
+            dimension_paste = int(dimension*dim_mul)
+            paste_picture = Image.new('RGB',(dimension_paste,dimension_paste),color.rgb)
+
+            if (secondary_scale is not None) & (picture.secondary is not None):
+                secondary = picture.secondary
+                dimension_2 = int(dimension*min(0.5,secondary_scale))
+                paste_secondary = Image.new('RGB',(dimension_2,dimension_2),secondary.rgb)
+                paste_picture.paste(paste_secondary,(int(dimension*0.5),int(dimension*0.5)))
+
+            if print_strength:
+                font_size = round(dimension/5)
+                font = ImageFont.truetype('arial.ttf',font_size) ### LINK SOMEWHERE
+                strength_text = '{:.03f}'.format(self.cells[(i,j)].strength)
+                target_text = '{}'.format(self.cells[(i,j)].picture.target)
+                rgb_text = '({},{},{})'.format(*self.cells[(i,j)].picture.color.rgb)
+
+                texts = [strength_text,target_text,rgb_text]
+                draw = ImageDraw.Draw(paste_picture)
+
+                for text in texts:
+                    draw.text((0,texts.index(text)*(font_size+1)),text,(255,255,255),font=font)
+                paste_picture = draw.im
+
+        else:
+            photo = library.get_photo(picture.id)
+            dim_resize = int(dimension*dim_mul + border*(dim_mul-1))
+            if tiles is not None:
+                paste_picture = tiles.get(photo,dim_resize)
+            else:
+                paste_picture = photo.square(dim_resize)
+
+        if self.CS.lattice == 'cartesian':
+            paste_mask = None
+
+        elif self.CS.lattice == 'hexagonal':
+            paste_mask = Shaper.mask('hexagon',paste_picture.width,paste_picture.height,size=self.center_size//2+1 if center else 1)
+
+        return paste_picture,paste_mask
\ No newline at end of file
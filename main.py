@@ -1,48 +1,79 @@
 ### MAIN SCRIPT ###
 from sorting import *
 
-print('*** OCELOT V2.9 ***\n')
+if __name__ == '__main__':
+    print('*** OCELOT V2.9 ***\n')
 
-# assemble folders
-project = Project()
+    # assemble folders
+    project = Project()
 
-# get all media
-finder = Finder(project)
-finder.find()
+    # color analysis settings, shared by ingest workers and the gallery
+    analysis = {'round_color':True,'grey_pct':0.75,'dark_pct':0.6,
+                'grey_threshold':16,'dark_threshold':100,'round_threshold':16,'dimension':50}
 
-# reduce to colors
-collector = Collector(finder)
+    # get all media
+    finder = Finder(project,analysis=analysis)
+    finder.find()
 
-center=project.profile_folder if (project.use_profile & (project.profile_size>0)) else None
+    # reduce to colors
+    collector = Collector(finder)
 
-collector.create_gallery(remove_duplicates=project.remove_duplicates,round_color=True,grey_pct=0.75,dark_pct=0.6,
-                         grey_threshold=16,dark_threshold=100,round_threshold=16,dimension=50,aspect=project.grid_aspect,
-                         randomize=True,stories=project.stories_folder,videos=project.videos_folder,
-                         center=project.profile_folder if (project.use_profile & (project.profile_size>0)) else None)
+    center=project.profile_folder if (project.use_profile & (project.profile_size>0)) else None
 
-# set up printer
-printer = Printer(collector,name=project.grid_name,dimension=project.grid_dimension,
-                  target_aspect=project.grid_aspect if (project.grid_aspect is not None) & project.grid_aspect_force else None,
-                  debugging=project.debugging)
+    collector.create_gallery(remove_duplicates=project.remove_duplicates,aspect=project.grid_aspect,**analysis,
+                             randomize=True,stories=project.stories_folder,videos=project.videos_folder,
+                             center=project.profile_folder if (project.use_profile & (project.profile_size>0)) else None,
+                             cache=project.color_cache_path)
 
-for run in project.runs:
-    # assemble photos
-    engine = Engine(printer)
-    engine.assemble(collector)
-    project.add_result('initial',engine.get_strength())
+    # set up printer
+    printer = Printer(collector,name=project.grid_name,dimension=project.grid_dimension,
+                      target_aspect=project.grid_aspect if (project.grid_aspect is not None) & project.grid_aspect_force else None,
+                      debugging=project.debugging)
 
-    # seed by color
-    engine.reseed()
-    project.add_result('reseed',engine.get_strength())
+    # fix the random restarts when a seed is given
+    seeds = [None if project.seed is None else project.seed + run for run in project.runs]
 
-    # improve assembly
-    engine.swap_worst(trials=project.trials)
-    engine.finalize()
-    project.add_result('iterations',engine.n_trials)
-    project.add_result('final',engine.get_strength())
+    if (project.workers > 1) & (not project.update_layout):
+        # run restarts in parallel and render only the strongest
+        print('\nRunning {} restarts on {} workers...'.format(len(seeds),project.workers))
+        restarts = Engine.run_restarts(project,collector.get_gallery(),seeds,workers=project.workers)
+        for results,_ in restarts:
+            for period,result in results:
+                project.add_result(period,result)
 
-    # finish and print
-    printer.finalize()
+        engine = Engine(printer)
+        engine.grid = max([grid for _,grid in restarts],key=lambda grid: grid.get_tautness())
+        engine.finalize()
 
-    # summarize results
-    project.summarize()
\ No newline at end of file
+        # keep layout for the next update
+        if project.layout_path:
+            engine.grid.save_layout(project.layout_path,collector.get_gallery())
+
+        # finish and print
+        printer.finalize()
+
+        # summarize results
+        project.summarize()
+
+    else:
+        for seed in seeds:
+            # assemble photos, seed by color and improve assembly
+            # or place only what changed since the saved layout
+            engine = Engine(printer)
+            if project.update_layout:
+                results = engine.update(collector.get_gallery(),Grid.load_layout(project.layout_path),seed=seed)
+            else:
+                results = engine.restart(collector.get_gallery(),seed=seed)
+            for period,result in results:
+                project.add_result(period,result)
+            engine.finalize()
+
+            # keep layout for the next update
+            if project.layout_path:
+                engine.grid.save_layout(project.layout_path,collector.get_gallery())
+
+            # finish and print
+            printer.finalize()
+
+            # summarize results
+            project.summarize()
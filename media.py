@@ -3,23 +3,112 @@ from common import *
 from coloring import *
 from plotting import *
 import random
-from PIL import Image,ImageChops,ImageDraw
+from PIL import Image,ImageChops,ImageDraw,GifImagePlugin
 import cv2
 import numpy
+import json
+from collections import OrderedDict
+import hashlib
+import tempfile
+
+# version of the color analysis, stored with cached colors
+# bump when prominent, secondary or greyscale colors would come out differently
+ANALYSIS_VERSION = 1
+
+# resampling filter for reduced images, the one Pillow also names ANTIALIAS in older versions
+RESAMPLE = Image.LANCZOS
 
 class Photo:
     # image with an id
-    def __init__(self,fn,image=None):
+    # pixels are loaded on demand from a source rather than held open
+    # source: ('file',path), ('video',path,frame) or ('crop',source,box)
+    # photos in a library share its image store, otherwise each use loads the source again
+    def __init__(self,fn,image=None,source=None):
         self.id = fn
-        if image is None:
+        if (image is None) & (source is None):
             if Common.extension_in(fn,['jpg','jpeg','gif','tif','bmp','png']):
-                image = Image.open(fn)
+                source = ('file',fn)
             elif Common.extension_in(fn,['avi','mp4','mov']):
-                video = Video(fn)
-                image = video.get_photos(first_only=True)
-            else:
-                image = None
-        self.image = image
+                source = ('video',fn,0)
+        self.source = source
+        self.held = image
+        self.store = None
+
+    @property
+    def image(self):
+        # held image, or the image from the store or source
+        if self.held is not None:
+            image = self.held
+        elif self.store is not None:
+            image = self.store.get(self)
+        else:
+            image = self.load()
+        return image
+
+    def load(self):
+        # read pixels from the source
+        return Photo.load_source(self.source)
+
+    def load_source(source):
+        # read pixels from a file, video frame or crop of either
+        image = None
+        if source is None:
+            pass
+        elif source[0] == 'file':
+            with Image.open(source[1]) as opened:
+                opened.load()
+                image = opened
+        elif source[0] == 'video':
+            image = Video(source[1]).get_frame(source[2])
+        elif source[0] == 'crop':
+            parent = Photo.load_source(source[1])
+            image = parent.crop(source[2]) if parent is not None else None
+        return image
+
+    def release(self):
+        # give up a held image that can be loaded again from the source
+        image = None
+        if self.source is not None:
+            image = self.held
+            self.held = None
+        return image
+
+    def reduced(self,size):
+        # image decoded at a smaller scale, but no smaller than size, where the file format allows
+        # JPEG files are opened in draft mode so only the reduced image is decoded
+        if (self.held is None) and (self.source is not None) and (self.source[0] == 'file') and \
+            Common.extension_in(self.source[1],['jpg','jpeg']):
+            with Image.open(self.source[1]) as opened:
+                opened.draft(opened.mode,(size,size))
+                image = opened.copy()
+        else:
+            image = self.image
+        return image
+
+    def source_file(self):
+        # file the pixels come from, or None
+        source = self.source
+        while (source is not None) and (source[0] == 'crop'):
+            source = source[1]
+        if source is not None:
+            path = source[1]
+        elif os.path.isfile(self.id):
+            path = self.id
+        elif os.path.isfile(self.id[:self.id.rfind('_')]):
+            path = self.id[:self.id.rfind('_')]
+        else:
+            path = None
+        return path
+
+    def square(self,size):
+        # center square of the image resized to size
+        image = self.image
+        h,w = image.size
+        if h != w:
+            m = min(h,w)/2
+            image = image.crop((int(h/2-m),int(w/2-m),int(h/2+m),int(w/2+m)))
+        image = image.resize((size,size),RESAMPLE)
+        return image
 
     def crop_photo(self,cut_range=20,std_threshold=5,color_threshold=(1,1,1)):
         # see if there is a line in the middle of the photo and split image
@@ -47,7 +136,8 @@ class Photo:
         if boundary:
             crop_box_top = (0,0,w,int(h/2))
             crop_box_bottom = (0,int(h/2),w,h)
-            photos = [Photo(self.id,image.crop(crop_box)) for crop_box in [crop_box_top,crop_box_bottom]]
+            photos = [Photo(self.id,image.crop(crop_box),source=('crop',self.source,crop_box) if self.source else None) \
+                      for crop_box in [crop_box_top,crop_box_bottom]]
         else:
             photos = [self]
 
@@ -66,25 +156,199 @@ class Video:
 
     def get_photos(self,tick=60,first_only=False):
         # export periodic frames as images
+        photos = list(self.iter_photos(tick=tick,first_only=first_only))
+        return photos
+
+    def iter_photos(self,tick=60,first_only=False):
+        # yield periodic frames as images while decoding forward once
+        # skipped frames are only grabbed, and frames that fail to decode are left out
         cap = cv2.VideoCapture(self.id)
 
-        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        frames = [0] if first_only else range(0,frame_count,tick)
+        f = 0
+        n = 0
+        try:
+            while cap.grab():
+                if f % tick == 0:
+                    success,cv2_image = cap.retrieve()
+                    if success:
+                        yield Photo('{}_{}'.format(self.id,n),self._cv2_to_image(cv2_image),source=('video',self.id,f))
+                        n += 1
+                    if first_only:
+                        break
+                f += 1
+        finally:
+            cap.release()
+
+    def get_frame(self,frame):
+        # read a single frame as an image
+        cap = cv2.VideoCapture(self.id)
+        if frame > 0:
+            cap.set(cv2.CAP_PROP_POS_FRAMES,frame)
+        success,cv2_image = cap.read()
+        cap.release()
 
-        photos = []
-        for f in frames:
-            cap.set(cv2.CAP_PROP_POS_FRAMES,f)
-            success,cv2_image = cap.read()
-            photos.append(Photo('{}_{}'.format(self.id,len(photos)),self._cv2_to_image(cv2_image)))
+        image = self._cv2_to_image(cv2_image) if success else None
+        return image
 
-        cap.release()
+class ImageStore:
+    # least recently used images up to a budget of bytes
+    # images that are pushed out are loaded again from their photo's source
+    def __init__(self,budget=2**29):
+        self.budget = budget
+        self.images = OrderedDict()
+        self.used = 0
 
-        return photos
+    def _bytes(self,image):
+        # memory taken by an image's pixels
+        return image.width * image.height * len(image.getbands())
+
+    def get(self,photo:Photo):
+        # return a photo's image, loading it if not stored
+        image = self.find(photo.id)
+        if image is None:
+            image = photo.load()
+            self.put(photo.id,image)
+        return image
+
+    def find(self,id):
+        # return a stored image or None
+        image = self.images.get(id)
+        if image is not None:
+            self.images.move_to_end(id)
+        return image
+
+    def put(self,id,image):
+        # store an image and push out the least recently used past the budget
+        if image is not None:
+            if id in self.images:
+                self.used -= self._bytes(self.images.pop(id))
+            self.images[id] = image
+            self.used += self._bytes(image)
+            while (self.used > self.budget) & (len(self.images) > 1):
+                _,removed = self.images.popitem(last=False)
+                self.used -= self._bytes(removed)
+
+    def merge(self,store):
+        # take the images of another store
+        if store is not self:
+            for id,image in store.images.items():
+                self.put(id,image)
+
+class TileCache:
+    # square crops of photos at render sizes, so repeated renders only paste
+    # kept in memory up to a budget, and in a folder between runs if one is given
+    # tiles on disk are named for the photo, the size and the source file's modified time and size
+    def __init__(self,folder=None,budget=2**28):
+        self.folder = folder
+        self.store = ImageStore(budget=budget)
+        if self.folder is not None:
+            os.makedirs(self.folder,exist_ok=True)
+
+    def _path(self,photo:Photo,size):
+        # file for a tile, or None if it can't be checked against its source
+        path = None
+        source = photo.source_file()
+        if (self.folder is not None) and (source is not None):
+            stat = os.stat(source)
+            name = '{}|{}|{}|{}'.format(photo.id,size,stat.st_mtime_ns,stat.st_size)
+            path = '{}/{}.png'.format(self.folder,hashlib.sha1(name.encode()).hexdigest())
+        return path
+
+    def get(self,photo:Photo,size):
+        # return the square tile of a photo at a size
+        key = (photo.id,size)
+        tile = self.store.find(key)
+        if tile is None:
+            path = self._path(photo,size)
+            if (path is not None) and os.path.isfile(path):
+                with Image.open(path) as opened:
+                    opened.load()
+                    tile = opened
+            else:
+                tile = photo.square(size)
+                if path is not None:
+                    tile.save(path)
+            self.store.put(key,tile)
+        return tile
+
+class ImageHash:
+    # 64-bit perceptual hashes of images, close in hamming distance for near duplicate images
+    def average(image,size=8):
+        # pixels brighter than the mean of a small greyscale copy
+        pixels = ImageHash._grey(image,(size,size))
+        bits = pixels > pixels.mean()
+        return ImageHash._to_int(bits)
+
+    def difference(image,size=8):
+        # pixels brighter than their left neighbor in a small greyscale copy
+        pixels = ImageHash._grey(image,(size+1,size))
+        bits = pixels[:,1:] > pixels[:,:-1]
+        return ImageHash._to_int(bits)
+
+    def perceptual(image,size=8,scale=4):
+        # low frequency DCT terms above their median
+        n = size*scale
+        pixels = ImageHash._grey(image,(n,n))
+        k = numpy.arange(n)
+        dct = numpy.cos(math.pi*(2*k[None,:]+1)*k[:,None]/(2*n))
+        frequencies = dct.dot(pixels).dot(dct.T)[:size,:size]
+        bits = frequencies > numpy.median(frequencies)
+        return ImageHash._to_int(bits)
+
+    def hamming(hash1,hash2):
+        # number of differing bits
+        return bin(hash1 ^ hash2).count('1')
+
+    def _grey(image,size):
+        # small greyscale copy as an array
+        return numpy.asarray(image.convert('L').resize(size,RESAMPLE),dtype=float)
+
+    def _to_int(bits):
+        # pack an array of bits into an int
+        return int.from_bytes(numpy.packbits(bits.flatten()).tobytes(),'big')
+
+class BKTree:
+    # metric tree of hashes for finding everything within a distance without checking every hash
+    # each node is [key,value,{distance:child}]
+    def __init__(self,distance=ImageHash.hamming):
+        self.distance = distance
+        self.root = None
+        self.size = 0
+
+    def add(self,key,value=None):
+        # insert a key below the node at each matching distance
+        self.size += 1
+        if self.root is None:
+            self.root = [key,value,{}]
+        else:
+            node = self.root
+            while True:
+                d = self.distance(key,node[0])
+                if d in node[2]:
+                    node = node[2][d]
+                else:
+                    node[2][d] = [key,value,{}]
+                    break
+
+    def find(self,key,radius):
+        # return (distance,key,value) of all keys within a radius
+        found = []
+        nodes = [self.root] if self.root is not None else []
+        while len(nodes):
+            node = nodes.pop()
+            d = self.distance(key,node[0])
+            if d <= radius:
+                found.append((d,node[0],node[1]))
+            # children between d-radius and d+radius can hold a match
+            nodes.extend(child for distance,child in node[2].items() if abs(distance-d) <= radius)
+        return found
 
 class Library:
     # collection of photos
-    def __init__(self,photos=None):
+    # images of photos with a source are kept in a shared store with a memory budget
+    def __init__(self,photos=None,store:ImageStore=None):
         self.photos = {}
+        self.store = store if store is not None else ImageStore()
         if photos is not None:
             self.add_photos(photos)
 
@@ -94,6 +358,8 @@ class Library:
         # add a photo to library
         if photo.id not in self.photos:
             self.photos[photo.id] = photo
+            photo.store = self.store
+            self.store.put(photo.id,photo.release())
 
     def add_photos(self,photos_list):
         # add photos to library
@@ -106,9 +372,42 @@ class Library:
 
     def merge_library(self,library):
         # combine two libraries
+        self.store.merge(library.store)
+        for photo in library.photos.values():
+            photo.store = self.store
         self.photos.update(library.photos)
 
-    def purge(self,dimension=10,threshold=0.9,greys=50):
+    def purge(self,method='dhash',radius=4,dimension=10,threshold=0.9,greys=50):
+        # remove duplicate photos, keeping the first of each
+        # method: ahash, dhash or phash to drop photos within a hamming radius of a kept photo's hash
+        #         or pixels to compare small copies against every kept photo
+        if method == 'pixels':
+            purge_count = self._purge_pixels(dimension=dimension,threshold=threshold,greys=greys)
+        else:
+            purge_count = self._purge_hashes(method=method,radius=radius)
+        return purge_count
+
+    def _purge_hashes(self,method='dhash',radius=4):
+        # remove photos with a perceptual hash near one already kept
+        hasher = {'ahash':ImageHash.average,
+                  'dhash':ImageHash.difference,
+                  'phash':ImageHash.perceptual}[method]
+        uniques = BKTree()
+        photos = {}
+        for photo in self.photos:
+            photo_hash = hasher(self.photos[photo].reduced(32))
+            if len(uniques.find(photo_hash,radius)) == 0:
+                uniques.add(photo_hash,photo)
+                photos[photo] = self.photos[photo]
+
+        print(' ...verified 100% ')
+
+        purge_count = len(self.photos) - len(photos)
+        self.photos = photos
+
+        return purge_count
+
+    def _purge_pixels(self,dimension=10,threshold=0.9,greys=50):
 #    def purge(self,dimension=10,color_threshold=16,difference_threshold=0.9,greys=50):
         # remove duplicate photos based on pixel content
         ## FUTURE IDEA: split into RGB and sort by histograms
@@ -216,7 +515,7 @@ class Pixelation:
     def __init__(self,photo:Photo,round_color=False,grey_pct=100,dark_pct=100,
                  grey_threshold=16,dark_threshold=100,round_threshold=16,
                  dimension=0):
-        self.im = photo.image.resize((min(10,dimension),min(10,dimension)))
+        self.im = photo.reduced(min(10,dimension)).resize((min(10,dimension),min(10,dimension)))
         self.id = photo.id
         self.display = '~/'+self.id[self.id.rfind('/')+1:]
 
@@ -239,7 +538,29 @@ class Pixelation:
         self.sorted = False
 
         if round_color:
-            self.nearest_color(grey_pct,dark_pct)
+            self.nearest_color(grey_pct,dark_pct,grey_threshold=grey_threshold,
+                               dark_threshold=dark_threshold,round_threshold=round_threshold)
+
+    def analyze(photos,round_color=False,grey_pct=100,dark_pct=100,
+                grey_threshold=16,dark_threshold=100,round_threshold=16,dimension=0):
+        # prominent, secondary and greyscale colors for each photo
+        # rounded colors of all photos are bucketed and ranked together in a palette
+        colors = []
+        if round_color:
+            pixel_counts = []
+            for photo in photos:
+                px = Pixelation(photo,dimension=dimension)
+                print(' ...extracting colors for {}'.format(px.display),end='\r')
+                pixel_counts.append(list(zip(px.freq,px.pixels)))
+            if len(pixel_counts):
+                palette = Palette(pixel_counts,grey_pct=grey_pct,dark_pct=dark_pct,grey_threshold=grey_threshold,
+                                  dark_threshold=dark_threshold,round_threshold=round_threshold)
+                colors = [palette.get_colors(n) for n in range(len(pixel_counts))]
+        else:
+            for photo in photos:
+                px = Pixelation(photo,dimension=dimension)
+                colors.append([px.prominent_color(),px.secondary_color(),px.prominent_color(vibrant=False)])
+        return colors
 
     def nearest_color(self,grey_pct=100,dark_pct=100,
                       grey_threshold=16,dark_threshold=100,round_threshold=16):
@@ -250,17 +571,12 @@ class Pixelation:
         greys = {}
         vibrants = {}
 
-        for c in range(len(self.pixels)):
-            red,green,blue = self.pixels[c]
-            color = Color(red,green,blue)
-            red,green,blue = color.nearest_color(threshold=round_threshold)
-
-            if color.is_dark(threshold=dark_threshold):
-                darks[(red,green,blue)] = darks.get((red,green,blue),0) + self.freq[c]
-            elif color.is_grey(threshold=grey_threshold):
-                greys[(red,green,blue)] = greys.get((red,green,blue),0) + self.freq[c]
-            else:
-                vibrants[(red,green,blue)] = vibrants.get((red,green,blue),0) + self.freq[c]
+        # round and categorize all pixels at once, then count buckets in pixel order
+        rounded,category = Palette.categorize([pixel[:3] for pixel in self.pixels],grey_threshold=grey_threshold,
+                                              dark_threshold=dark_threshold,round_threshold=round_threshold)
+        counts = (darks,greys,vibrants)
+        for rgb,c,freq in zip(map(tuple,rounded.tolist()),category.tolist(),self.freq):
+            counts[c][rgb] = counts[c].get(rgb,0) + freq
                
         if (len(vibrants) == 0) | (sum(darks.values()) > dark_pct*self.size):
             vibrants.update(darks)
@@ -335,13 +651,73 @@ class Pixelation:
                 color_count = max(len(self.prominence_dull),len(self.prominence))
                 while (n < color_count) & (distance < threshold/2):
                     best = self.prominent_color(n=n,vibrant=False)
-                    distance = prominent.distance(best)
+                    distance = prominent.difference(best)
                     n += 1
                 if prominent == best:
                     best = self.prominent_color(n=-1,vibrant=False)
             secondary = best
         return secondary
 
+class ColorCache:
+    # colors found for photos on earlier runs, kept in a json file
+    # an entry is reused only if its source file, the analysis version and the analysis settings are unchanged
+    # stats: file stats by path from a scan, so files are not checked again
+    def __init__(self,path=None,stats=None):
+        self.path = path
+        self.stats = stats if stats is not None else {}
+        self.entries = {}
+        self.changed = False
+        if (path is not None) and os.path.isfile(path):
+            try:
+                with open(path,'r') as f:
+                    self.entries = json.load(f)
+            except (OSError,ValueError):
+                self.entries = {}
+
+    def _stamp(self,id,settings):
+        # file modified time, file size, analysis version and settings for a photo id
+        # video frames are numbered after their source file
+        source = id
+        if (source not in self.stats) & ('_' in source):
+            if (source[:source.rfind('_')] in self.stats) or (not os.path.isfile(source)):
+                source = source[:source.rfind('_')]
+        stat = self.stats.get(source)
+        if (stat is None) and os.path.isfile(source):
+            stat = os.stat(source)
+        if stat is not None:
+            stamp = [stat.st_mtime_ns,stat.st_size,ANALYSIS_VERSION,sorted(settings.items())]
+            # match the lists that come back from json
+            stamp = json.loads(json.dumps(stamp))
+        else:
+            stamp = None
+        return stamp
+
+    def get(self,id,settings):
+        # return prominent, secondary and greyscale colors if still valid
+        colors = None
+        entry = self.entries.get(id)
+        if entry is not None:
+            stamp = self._stamp(id,settings)
+            if (stamp is not None) and (entry['stamp'] == stamp):
+                colors = [Color.lookup(*rgb) for rgb in entry['colors']]
+        return colors
+
+    def put(self,id,settings,colors):
+        # store prominent, secondary and greyscale colors
+        stamp = self._stamp(id,settings)
+        if stamp is not None:
+            self.entries[id] = {'stamp':stamp,'colors':[list(color.rgb) for color in colors]}
+            self.changed = True
+
+    def save(self):
+        # write the cache if anything was added
+        if (self.path is not None) & self.changed:
+            temp_path = self.path + '.tmp'
+            with open(temp_path,'w') as f:
+                json.dump(self.entries,f)
+            os.replace(temp_path,self.path)
+            self.changed = False
+
 class Picture:
     # color block with a linked file name and RGB weights
     def __init__(self,id,color,secondary=None,greyscale=None):
@@ -406,16 +782,39 @@ class Gallery:
 
     def from_library(library,round_color=False,grey_pct=100,dark_pct=100,
                      grey_threshold=16,dark_threshold=100,round_threshold=16,
-                     dimension=0,aspect=(1,1),randomize=True,stories='stories',videos='videos',center=None): ##,coordinate_system=CoordinateSystem()):
+                     dimension=0,aspect=(1,1),randomize=True,stories='stories',videos='videos',center=None,
+                     cache:ColorCache=None,analyzed=None): ##,coordinate_system=CoordinateSystem()):
         # construct a gallery from a library
-        pixelation = [Pixelation(library.get_photo(photo),round_color=round_color,
-                                 grey_pct=grey_pct,dark_pct=dark_pct,
-                                 grey_threshold=grey_threshold,dark_threshold=dark_threshold,
-                                 round_threshold=round_threshold,
-                                 dimension=dimension) for photo in library.photos]
-        pictures = [Picture(px.id,px.prominent_color(),
-                            secondary=px.secondary_color(),
-                            greyscale=px.prominent_color(vibrant=False)) for px in pixelation]
+        # colors found on an earlier run are taken from the cache without opening the image
+        # analyzed: colors already found with the same settings, by photo id
+        settings = {'round_color':round_color,'grey_pct':grey_pct,'dark_pct':dark_pct,
+                    'grey_threshold':grey_threshold,'dark_threshold':dark_threshold,
+                    'round_threshold':round_threshold,'dimension':dimension}
+        found = {}
+        pending = []
+        for photo in library.photos:
+            colors = cache.get(photo,settings) if cache is not None else None
+            if (colors is None) and (analyzed is not None):
+                colors = analyzed.get(photo)
+                if (colors is not None) & (cache is not None):
+                    cache.put(photo,settings,colors)
+            if colors is None:
+                pending.append(photo)
+            else:
+                found[photo] = colors
+
+        # analyze everything else together
+        analysis = Pixelation.analyze([library.get_photo(photo) for photo in pending],**settings)
+        for photo,colors in zip(pending,analysis):
+            found[photo] = colors
+            if cache is not None:
+                cache.put(photo,settings,colors)
+
+        pictures = [Picture(photo,found[photo][0],secondary=found[photo][1],greyscale=found[photo][2]) for photo in library.photos]
+
+        if cache is not None:
+            cache.save()
+
         gallery = Gallery(pictures,randomize=randomize,stories=stories,videos=videos,center=center) ##,coordinate_system=coordinate_system)
     
         print('\n')
@@ -426,75 +825,50 @@ class Gallery:
         # return nth picture
         return self.pictures[n]
 
-    def get_hsv_corner(self,color:Color,angle=0,hues=[]):
-        # find corner for a color based on its HSV
-        # angle determined by hue -- h is 0 to 1
-        # for whiter pics (lower saturation), move to middle -- l is 0 to 1
-        # for darker pics (lower vibrance), move away from middle -- v is 0 to 255
-        h,s,v = color.hsv
-        if len(hues) > 0:
-            h = hues.index(h)/len(hues)
-        H = CoordinateSystem.angle_simplified(h * 2*math.pi + angle)
-        S = s
-        V = v/255
+    def get_hsv_corners(self,angle=0):
+        # polar corners and darkness of every picture based on its HSV
+        # the angle comes from each hue's rank among all hues, with equal hues taking the first rank,
+        # turned by angle, and every picture sits at the same radius
+        hues = numpy.array([picture.color.hsv[0] for picture in self.pictures],dtype=float)
+        ranks = numpy.searchsorted(numpy.sort(hues),hues,side='left')
+        H = numpy.mod(ranks/max(1,len(hues)) * 2*math.pi + angle,2*math.pi)
+        H = numpy.where(H < math.pi,H,H-2*math.pi)
         R = 0.375
 
         # darkness outweighs whiteness
-        dark = color.is_dark()
-        if dark:
-            S = 1
-      
-        return R,H,dark
+        dark = numpy.array([picture.color.is_dark() for picture in self.pictures],dtype=bool)
 
-    def cycle_list(self,values,n):
-        # return every nth element to distribute evenly
-        cycled = [values[v] for m in range(n) for v in range(len(values)) if v%n == m]
-        return cycled
+        return R,H,dark
 
-    def order_pictures(self,stories='stories',videos='videos'):
+    def order_pictures(self,stories='stories',videos='videos',angle=None):
         # assign an order to add pictures based on prominent color
-
-        # place based on color wheel
-        sorted_dark = []
-        dark_hues = []
-        sorted_vibrant = []
-        vibrant_hues = []
+        # angle: turn of the color wheel, random if not given
 
         # place at an angle
-        self.angle = CoordinateSystem.angle_simplified(random.random()*2*math.pi)
-        
-        hues = sorted([picture.color.hsv[0] for picture in self.pictures])
-
-        for picture in self.pictures:
-            # get corner and darkness
-            R,H,dark = self.get_hsv_corner(picture.color,angle=self.angle,hues=hues)
-            self.corners[picture.id] = (R,H)
-
-            self.pictures[self.pictures.index(picture)].angle = H
-            self.pictures[self.pictures.index(picture)].dark = dark
-
-            # order pictures based on darkness
-            if dark:
-                sorted_dark.append(picture)
-                dark_hues.append(H)
-            else:
-                sorted_vibrant.append(picture)
-                vibrant_hues.append(H)
-    
-        sorted_dark = Common.sort_by_list(sorted_dark,dark_hues)
-        sorted_vibrant = Common.sort_by_list(sorted_vibrant,vibrant_hues)
-
-        sorted_order = sorted_dark + self.cycle_list(sorted_vibrant,6)
-
-        sorted_pics = [p for p in self.pictures if all(('/{}/'.format(stories) not in p.id,'/{}/'.format(videos) not in p.id))]
-        sorted_stories = [p for p in self.pictures if all(('/{}/'.format(stories) in p.id,'/{}/'.format(videos) not in p.id))]
-        sorted_videos = [p for p in self.pictures if '/{}/'.format(videos) in p.id]
-        sorted_order = sorted_pics + sorted_stories + sorted_videos
-
-        self.pictures = sorted_order
+        if angle is None:
+            angle = CoordinateSystem.angle_simplified(random.random()*2*math.pi)
+        self.angle = angle
+
+        # get corners and darkness
+        R,H,dark = self.get_hsv_corners(angle=self.angle)
+        for picture,h,d in zip(self.pictures,H.tolist(),dark.tolist()):
+            self.corners[picture.id] = (R,h)
+            picture.angle = h
+            picture.dark = d
+
+        # photos first, then stories, then videos
+        categories = [self.category(picture,stories,videos) for picture in self.pictures]
+        self.pictures = [self.pictures[i] for i in numpy.argsort(categories,kind='stable')]
+
+    def category(self,picture:Picture,stories='stories',videos='videos'):
+        # order of a picture's kind when adding: 0 for photos, 1 for stories, 2 for videos
+        category = 2 if '/{}/'.format(videos) in picture.id else 1 if '/{}/'.format(stories) in picture.id else 0
+        return category
 
 class Shaper:
     # manipulations to an image
+    masks = {} # masks already drawn by shape, image size and shape size
+
     def _cut(shape,size=1,dim=1):
         # return a pattern for a shape
         ratios = {'hexagon':math.sqrt(3)/2,
@@ -535,28 +909,24 @@ class Shaper:
     
         return pattern,ratio
 
+    def mask(shape,width,height,size=1):
+        # return an 'L' mask of a shape for an image size, drawn once and reused
+        key = (shape,width,height,size)
+        if key not in Shaper.masks:
+            pattern,ratio = Shaper._cut(shape,size,min(width,height))
+            maskIm = Image.new('L',(width,height),0)
+            if shape == 'hexagon':
+                ImageDraw.Draw(maskIm).polygon(pattern,outline=255,fill=255)
+            elif shape == 'circle':
+                ImageDraw.Draw(maskIm).ellipse(pattern,outline=255,fill=255)
+            Shaper.masks[key] = maskIm
+        return Shaper.masks[key]
+
     def shape(image:Image,shape,size=1):
         # cut an image to a shape
         w,h = image.size
-        dim = min(w,h)
-        pattern,ratio = Shaper._cut(shape,size,dim)
-
-        # convert to numpy and create mask
-        imArray = numpy.asarray(image.convert('RGBA'))
-        maskIm = Image.new('L',(imArray.shape[1],imArray.shape[0]),0)
-        if shape == 'hexagon':
-            ImageDraw.Draw(maskIm).polygon(pattern,outline=1,fill=1)
-        elif shape == 'circle':
-            ImageDraw.Draw(maskIm).ellipse(pattern,outline1=1,fill=1)
-        mask = numpy.array(maskIm)
-
-        # assemble new image (uint8: 0-255)
-        newImArray = numpy.empty(imArray.shape,dtype='uint8')
-        newImArray[:,:,:3] = imArray[:,:,:3] # colors (three first columns, RGB)
-        newImArray[:,:,3] = mask*255 # transparency (4th column)
-
-        shaped = Image.fromarray(newImArray,'RGBA')
-        shaped.resize((int(w/ratio),int(h/ratio)),Image.ANTIALIAS)
+        shaped = image.convert('RGB')
+        shaped.putalpha(Shaper.mask(shape,w,h,size))
         return shaped
 
     def blot(image:Image):
@@ -566,4 +936,57 @@ class Shaper:
         r[a==0],g[a==0],b[a==0] = (255,255,255)
         newImArray = numpy.dstack([r,g,b,a])
         blotted = Image.fromarray(newImArray,'RGBA').convert('RGB')
-        return blotted
\ No newline at end of file
+        return blotted
+
+class Animation:
+    # gif written a frame at a time so earlier frames are not kept in memory
+    # every frame is mapped to one palette taken from the first frame instead of being quantized on its own
+    # frames go to a temporary file in the folder until the animation is saved
+    def __init__(self,folder,size,duration=500,colors=256):
+        self.folder = folder
+        self.size = size
+        self.duration = duration
+        self.colors = colors
+
+        self.palette = None
+        self.pending = None
+        self.file = None
+        self.path = None
+
+    def _frame(self,image:Image):
+        # downscale an image and put it on the shared palette
+        image = image.convert('RGB').resize(self.size,RESAMPLE)
+        if self.palette is None:
+            self.palette = image.quantize(colors=self.colors)
+        return image.quantize(palette=self.palette,dither=0)
+
+    def _write(self,frame:Image,duration):
+        # write a frame, starting the file with a header and endless loop block if needed
+        # the NETSCAPE2.0 loop block is written here because Pillow versions differ on adding it to the header
+        if self.file is None:
+            handle,self.path = tempfile.mkstemp(suffix='.gif',dir=self.folder)
+            self.file = os.fdopen(handle,'wb')
+            header,_ = GifImagePlugin.getheader(frame,info={'duration':duration})
+            for block in header:
+                self.file.write(block)
+            self.file.write(b'!\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00')
+        for block in GifImagePlugin.getdata(frame,duration=duration):
+            self.file.write(block)
+
+    def add(self,image:Image):
+        # add a frame, holding it back in case it is the last one
+        frame = self._frame(image)
+        if self.pending is not None:
+            self._write(self.pending,self.duration)
+        self.pending = frame
+
+    def save(self,filename,hold=1000):
+        # finish the file with the last frame shown for longer and move it into place
+        if self.pending is not None:
+            self._write(self.pending,hold)
+            self.pending = None
+        if self.file is not None:
+            self.file.write(b';')
+            self.file.close()
+            os.replace(self.path,filename)
+            self.file = None
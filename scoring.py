@@ -0,0 +1,176 @@
+### SCORING OBJECTS ###
+from common import *
+from plotting import *
+import math
+
+class StrengthArray:
+    # array-backed copy of a grid's cells for batched strength calculations
+    # this is the one definition of cell strength: weighted placement terms, video frames next to frames
+    # of the same video, and the rest of the weight on squared color difference to neighbors
+    # slots: unblocked positions with a picture, in grid order
+    # position terms (neighbors, edges, angles) are fixed when built
+    # picture terms (colors, targets, angles, darkness, frames) move with swaps
+    rgb_weights = (2,4,3) # same weighting as Color.difference
+    rgb_scale = sum(rgb_weights) * 255**2
+
+    def __init__(self,grid):
+        self.grid = grid
+        self.positions = [position for position in grid._safe_cells() if grid.cells[position] is not None]
+        self.index = {position:n for n,position in enumerate(self.positions)}
+        self.size = len(self.positions)
+
+        self._add_positions()
+        self._add_neighbors()
+        self._add_pictures()
+
+    def _add_positions(self):
+        # precompute placement angle and normalized distance to the edge for each slot
+        grid = self.grid
+        self.xy = numpy.array(self.positions,dtype=float).reshape(-1,2)
+        x,y = self.xy[:,0],self.xy[:,1]
+        self.current_angles = numpy.arctan2(y-grid.width/2,x-grid.height/2)
+        self.edges = self._edge_distances(x,y)
+
+    def _edge_distances(self,x,y):
+        # matches CoordinateSystem.path_finder(position,to_edge=True,normalize=True)
+        CSM = self.grid.CSM
+        height,width,width2 = CSM.matrix[0],CSM.matrix[1],CSM.matrix[-1]
+        if CSM.lattice == 'cartesian':
+            edges = [(height,x),(0,x),(x,0),(x,width)]
+        elif CSM.lattice == 'hexagonal':
+            offset = x//2
+            edges = [(height,y+offset-height//2),(0,y+offset),(x,-offset),(x,numpy.where(x%2,width2,width)-offset)]
+        normal_NS = height/2
+        normal_WE = (width+width2)/4
+        normals = [normal_NS,normal_NS,normal_WE,normal_WE]
+
+        paths = [self._path(x,y,edge[0],edge[1])/normal for edge,normal in zip(edges,normals)]
+        distances = numpy.min(numpy.vstack(paths),axis=0)
+        return distances
+
+    def _path(self,x1,y1,x2,y2):
+        # shortest path between arrays of cells, as in CoordinateSystem.path_finder
+        if self.grid.CSM.lattice == 'hexagonal':
+            routes = numpy.sort(numpy.vstack(numpy.broadcast_arrays(abs(x1-x2),abs(y1-y2),abs(-(x1+y1)+(x2+y2)))),axis=0)
+            path = routes[0] + routes[1]
+        else:
+            path = abs(x1-x2) + abs(y1-y2)
+        return path
+
+    def _distance(self,xy1,xy2):
+        # distance on the grid's lattice, as in CoordinateSystem.distance
+        dx = xy1[...,0] - xy2[...,0]
+        dy = xy1[...,1] - xy2[...,1]
+        if self.grid.CS.lattice == 'hexagonal':
+            d = numpy.sqrt(dx**2 + dy**2 + (dx+dy)**2)/math.sqrt(2)
+        else:
+            d = numpy.sqrt(dx**2 + dy**2)
+        return d
+
+    def _angle_difference(self,angle1,angle2):
+        # matches CoordinateSystem.angle_difference for arrays of angles
+        # (an angle2 in the upper half circle is compared, otherwise angle1 is compared to itself)
+        angle1 = numpy.mod(angle1,2*math.pi)
+        angle2 = numpy.mod(angle2,2*math.pi)
+        angle2 = numpy.where(angle2 >= math.pi,angle2,angle1)
+        diff = abs(angle1 - angle2)
+        diff = numpy.minimum(diff,2*math.pi - diff)
+        return diff
+
+    def placement(self,slots,targets,angles,darks):
+        # distance, angle and dark terms for pictures placed at slots
+        # arrays broadcast, so a (P,k) block of candidate slots can be scored against (P,1) pictures
+        # returns the summed terms and the weight they take from color difference
+        weights = self.grid.weights
+        terms = numpy.zeros(numpy.broadcast(slots,angles,darks).shape)
+        used_weight = 0
+
+        # account for placement distance
+        if weights.get('distance') > 0:
+            used_weight += weights['distance']
+            distances = self._distance(self.xy[slots],targets)/self.grid.max_distance
+            terms += numpy.where(numpy.isnan(distances),0.5,distances)
+
+        # account for placement angle
+        if weights.get('angle') > 0:
+            used_weight += weights['angle']
+            angle_diff = self._angle_difference(self.current_angles[slots],angles+self.grid.angle)
+            terms += numpy.where(numpy.isnan(angles),0.5,weights['angle']*angle_diff/(2*math.pi))
+
+        # account for darkness
+        if weights.get('dark') > 0:
+            used_weight += weights['dark']
+            terms += weights['dark'] * darks * self.edges[slots]
+
+        return terms,used_weight
+
+    def _add_neighbors(self):
+        # padded (N,k) array of neighbor slots with -1 for no neighbor
+        neighbors = [[self.index[neighbor] for neighbor in self.grid.cells[position].neighbors \
+                      if (neighbor not in self.grid.blocked) & (neighbor in self.index)] for position in self.positions]
+        k = max([len(n) for n in neighbors] + [1])
+        self.neighbors = -numpy.ones((self.size,k),dtype=int)
+        for n,neighbor in enumerate(neighbors):
+            self.neighbors[n,:len(neighbor)] = neighbor
+        self.neighbor_mask = self.neighbors >= 0
+        self.neighbor_count = self.neighbor_mask.sum(1)
+
+    def _add_pictures(self):
+        # load picture attributes of every slot into one (N,9) array so a swap moves a single row
+        # columns: red,green,blue | target x,y | angle | dark | video | frame group
+        pictures = [self.grid.cells[position].picture for position in self.positions]
+        groups = {}
+        self.pictures = numpy.array([list(picture.color.rgb) + \
+                                     list(picture.target if picture.target is not None else (numpy.nan,numpy.nan)) + \
+                                     [picture.angle if picture.angle is not None else numpy.nan,
+                                      bool(picture.dark),
+                                      Common.extension_in(picture.id,['mp4']),
+                                      groups.setdefault(picture.id[:picture.id.rfind('_')].lower(),len(groups))] \
+                                     for picture in pictures],dtype=float).reshape(-1,9)
+
+    def swap(self,position1,position2):
+        # exchange the picture attributes of two slots
+        n1,n2 = self.index[position1],self.index[position2]
+        self.pictures[[n1,n2]] = self.pictures[[n2,n1]]
+
+    def strengths(self,positions=None):
+        # calculate strengths for some or all slots
+        if positions is None:
+            slots = numpy.arange(self.size)
+        else:
+            slots = numpy.array([self.index[position] for position in positions],dtype=int)
+
+        strengths = self.estimates(self.pictures[slots],slots[:,None])[:,0]
+
+        return strengths
+
+    def estimates(self,pictures,slots,shared=False):
+        # strength each picture would have at each of its slots, against the pictures around those slots now
+        # pictures: (P,9) rows as in self.pictures, slots: (P,k) slot indices
+        # shared: add the neighbors' side of each color difference, which counts toward the grid total as well
+        weights = self.grid.weights
+        mask = self.neighbor_mask[slots]
+        count = self.neighbor_count[slots]
+        per_count = 1/numpy.maximum(count,1)
+        pictures = pictures[:,None,:]
+        neighbors = self.pictures[self.neighbors[slots]] # padding rows are masked out below
+
+        # account for placement distance, angle and darkness
+        strengths,used_weight = self.placement(slots,pictures[...,3:5],pictures[...,5],pictures[...,6])
+
+        # account for video frames being next to each other
+        # frames match on their shared video id rather than by substring
+        if weights.get('frame') > 0:
+            used_weight += weights['frame']
+            same_video = (neighbors[...,8] == pictures[...,None,8]) & mask
+            strengths += pictures[...,7] * same_video.sum(-1) * per_count
+
+        # account for color difference
+        deltas = neighbors[...,:3] - pictures[...,None,:3]
+        differences = (deltas**2).dot(self.rgb_weights)/self.rgb_scale
+        strengths += (1-used_weight) * (differences*mask).sum(-1) * per_count
+        if shared:
+            neighbor_count = numpy.maximum(self.neighbor_count[self.neighbors[slots]],1)
+            strengths += (1-used_weight) * (differences*mask/neighbor_count).sum(-1)
+
+        return strengths
@@ -5,22 +5,28 @@ from media import *
 from layout import *
 from structure import *
 import copy
+import random
+import time
+import contextlib
+import concurrent.futures
 
 class Engine:
     # object that can create or make changes to a grid
-    def __init__(self,printer:Printer):
+    # without a printer, as in a worker process, nothing is rendered
+    def __init__(self,printer:Printer=None,project:Project=None):
         self.grid = None
         self.printer = printer
-        self.project = printer.project
+        self.project = printer.project if printer is not None else project
 
-        self.coordinate_system = printer.project.coordinate_system
+        self.coordinate_system = self.project.coordinate_system
         self.coordinate_matrix = None
 
         self.n_trials = 0
 
     def store_grid(self,dimension=50,full=False,extension='jpg'):
         # add a grid to the print queue
-        self.printer.store_grid(self.grid,full=full)
+        if self.printer is not None:
+            self.printer.store_grid(self.grid,full=full)
 
     def get_strength(self):
         # get result of grid strength for summary
@@ -32,9 +38,13 @@ class Engine:
         
     def assemble(self,collector:Collector):
         # put together images in initial grid layout
-        print('Setting up grid...')
-      
         gallery = collector.get_gallery()
+        self._assemble(gallery)
+
+    def _assemble(self,gallery:Gallery):
+        # lay out an analyzed gallery in an initial grid
+        print('Setting up grid...')
+
         # if the gallery didn't turn up a center image, then don't pass center
         center_size = self.project.profile_size if gallery.center else 0
 
@@ -139,11 +149,12 @@ class Engine:
 
         return height,width,width2,center_size
 
-    def reseed(self):
+    def reseed(self,refine=False):
         # place pictures according to coloring
+        # refine: improve the nearest-open-cell placement with local rounds of moves
         print('\nSeeding grid...')
         taut_0 = self.grid.get_tautness()
-        grid = self.grid.reseed()
+        grid = self.grid.reseed(refine=refine)
         self.grid = grid
 
         taut_1 = self.grid.get_tautness()
@@ -162,18 +173,18 @@ class Engine:
         swap_last = 0
 
         grid = self.grid.copy_grid()
-        pairings = self.grid.worst_pairings()
         try:
             self._update_trial(n)
             while (not exhausted):
                 worst = self.grid.worst_cells()
-                pair = 0
+                pairings = self.grid.worst_pairings()
+                pair = next(pairings,None)
                 move_on = False
 
-                while (not move_on) & (pair < len(pairings)) & (not exhausted):
+                while (not move_on) & (pair is not None) & (not exhausted):
                     n += 1
                     
-                    cells = worst[pairings[pair][0]],worst[pairings[pair][1]]
+                    cells = worst[pair[0]],worst[pair[1]]
                     cell1 = cells[0]
                     cell2 = cells[1]
 
@@ -186,8 +197,8 @@ class Engine:
                         move_on = True
                     else:
                         self._update_trial(n)
-                        pair += 1
-                        if (n - swap_last >= self.project.print_after) | (pair == len(pairings)):
+                        pair = next(pairings,None)
+                        if (n - swap_last >= self.project.print_after) | (pair is None):
                             exhausted = True
 
                     if (not n%self.project.print_after) & self.project.grid_gif:
@@ -207,6 +218,203 @@ class Engine:
         self.grid = grid
         return grid
 
+    def anneal(self,trials=None,time_limit=None,temperatures=(0.1,0.001),schedule='exponential',
+               proposal='random',radius=2,seed=None):
+        # swap cells at random and accept worse swaps with a falling probability
+        # temperatures: (start,end) in units of summed cell strength
+        # schedule: 'exponential' or 'linear' cooling over the budget
+        # proposal: 'random' pairs anywhere or 'neighborhood' pairs within radius steps
+        # budget is trials, time_limit in seconds or whichever runs out first
+        print('\nAnnealing grid...')
+        rng = random.Random(seed)
+        grid = self.grid
+        positions = grid._safe_cells()
+        # without a trial count or time limit, run a number of trials for the grid size
+        if (not trials) and (not time_limit):
+            trials = 100*len(positions)
+        t_start,t_end = temperatures
+
+        n = 0
+        start_time = time.time()
+        best_total = grid.strength_total
+        journal = [] # accepted swaps since the best arrangement
+        try:
+            self._update_trial(n)
+            progress = 0
+            while (progress < 1) & (len(positions) > 1):
+                n += 1
+                if schedule == 'linear':
+                    temperature = t_start + (t_end-t_start)*progress
+                else:
+                    temperature = t_start*(t_end/t_start)**progress
+
+                cell1,cell2 = self._propose_pair(positions,rng,proposal=proposal,radius=radius)
+                total_0 = grid.strength_total
+                grid.swap_pictures(cell1,cell2)
+                delta = grid.strength_total - total_0
+
+                if (delta <= 0) or (rng.random() < math.exp(-delta/temperature)):
+                    journal.append((cell1,cell2))
+                    if grid.strength_total < best_total:
+                        best_total = grid.strength_total
+                        journal = []
+                        self._update_trial(n,grid.get_tautness())
+                else:
+                    grid.swap_pictures(cell1,cell2)
+
+                if (not n%self.project.print_after) & self.project.grid_gif:
+                    self.store_grid()
+
+                progresses = []
+                if trials:
+                    progresses.append(n/trials)
+                if time_limit:
+                    progresses.append((time.time()-start_time)/time_limit)
+                progress = max(progresses,default=1)
+
+        except KeyboardInterrupt:
+            pass
+
+        # step back to the best arrangement seen
+        for cell1,cell2 in reversed(journal):
+            grid.swap_pictures(cell1,cell2)
+
+        self.n_trials = n
+        self._update_trial(n,grid.get_tautness())
+        if (n%self.project.print_after) & self.project.grid_gif:
+            self.store_grid()
+
+        print()
+        return grid
+
+    def _propose_pair(self,positions,rng,proposal='random',radius=2):
+        # pick two different cells to try swapping
+        cell1 = rng.choice(positions)
+        cell2 = cell1
+        while cell2 == cell1:
+            if proposal == 'neighborhood':
+                # random walk out from the first cell
+                cell1 = rng.choice(positions)
+                cell2 = cell1
+                for r in range(radius):
+                    neighbors = [neighbor for neighbor in self.grid.cells[cell2].neighbors \
+                                 if (neighbor not in self.grid.blocked) & (self.grid.cells.get(neighbor) is not None)]
+                    if len(neighbors):
+                        cell2 = rng.choice(neighbors)
+            else:
+                cell2 = rng.choice(positions)
+        return cell1,cell2
+
+    def restart(self,gallery:Gallery,seed=None):
+        # assemble, reseed and improve a grid from an analyzed gallery
+        # returns the strength after each step and the number of trials, in project result order
+        if seed is not None:
+            random.seed(seed)
+
+        results = []
+        self._assemble(gallery)
+        results.append(('initial',self.get_strength()))
+
+        # seed by color
+        self.reseed(refine=self.project.reseed_mode=='refine')
+        results.append(('reseed',self.get_strength()))
+
+        # improve assembly
+        if self.project.optimizer == 'anneal':
+            self.anneal(trials=self.project.trials,time_limit=self.project.time_limit,
+                        proposal=self.project.anneal_proposal,seed=seed)
+        else:
+            self.swap_worst(trials=self.project.trials)
+        results.append(('iterations',self.n_trials))
+        results.append(('final',self.get_strength()))
+
+        return results
+
+    def update(self,gallery:Gallery,layout,seed=None):
+        # bring a saved layout up to date with an analyzed gallery
+        # pictures keep their places and only the neighborhoods of changed cells are improved,
+        # unless the gallery no longer fits a grid of the saved shape and is laid out again
+        # returns results as in restart
+        if layout is None:
+            print('No saved layout, setting up a new grid')
+            return self.restart(gallery,seed=seed)
+
+        if seed is not None:
+            random.seed(seed)
+
+        print('Updating grid...')
+        center_size = self.project.profile_size if gallery.center else 0
+        height,width,width2,center_size = self._best_fit(gallery.size,self.project.grid_aspect,center_size=center_size)
+        grid = Grid(height,width,width2,weights=self.project.weights,
+                    coordinate_system=self.coordinate_system)
+        grid.add_center(center_size=center_size)
+        if not grid.fits_layout(layout):
+            print(' ...grid size changed, setting up a new grid')
+            return self.restart(gallery,seed=seed)
+
+        matrix = (height,width) if width2 == 0 else (height,width,width2)
+        self.coordinate_matrix = self.coordinate_system.make_matrix(matrix)
+
+        # color the gallery with the saved turn of the color wheel
+        gallery.order_pictures(angle=layout['angle'])
+        changed = grid.update_from_gallery(gallery,layout)
+        self.grid = grid
+        print(' ...placed {} new picture{}'.format(len(changed),'s' if len(changed) != 1 else ''))
+
+        # new pictures are seeded in the same step that places the saved ones
+        results = []
+        results.append(('initial',self.get_strength()))
+        results.append(('reseed',self.get_strength()))
+        if self.project.grid_gif:
+            self.store_grid(full=True)
+            self.store_grid()
+
+        self.polish(changed,radius=self.project.update_radius,trials=self.project.trials)
+        results.append(('iterations',self.n_trials))
+        results.append(('final',self.get_strength()))
+
+        return results
+
+    def polish(self,positions,radius=2,trials=None):
+        # swap the worst pairings within the neighborhoods of some positions, as in swap_worst,
+        # until the pairings run out or a run of trials finds no better swap
+        print('\nPolishing grid...')
+        region = self.grid.neighborhood(positions,radius=radius)
+        n = 0
+        exhausted = len(region) < 2
+        swap_last = 0
+        try:
+            self._update_trial(n)
+            while not exhausted:
+                worst = self.grid.worst_cells(region)
+                pairings = self.grid.worst_pairings(len(worst))
+                pair = next(pairings,None)
+                move_on = False
+
+                while (not move_on) & (pair is not None) & (not exhausted):
+                    n += 1
+                    if self.grid.check_swap(worst[pair[0]],worst[pair[1]]):
+                        swap_last = n
+                        self._update_trial(n,self.grid.get_tautness())
+                        move_on = True
+                    else:
+                        pair = next(pairings,None)
+                        if (n - swap_last >= self.project.print_after) | (pair is None):
+                            exhausted = True
+
+                    if trials and (n >= trials):
+                        exhausted = True
+
+        except KeyboardInterrupt:
+            pass
+
+        self.n_trials = n
+        if self.project.grid_gif:
+            self.store_grid()
+
+        print()
+        return self.grid
+
     def finalize(self):
         # put final arrangement in printer
         self.store_grid(full=True)
@@ -222,6 +430,15 @@ class Engine:
             improvement = ''
         print(' Trial {}{}'.format(n,improvement,spaces),end='\r')
 
+    def run_restarts(project:Project,gallery:Gallery,seeds,workers=None):
+        # run independent restarts across a process pool
+        # the project and gallery go to each worker once rather than with every run
+        # returns the results and final grid of each restart, in seed order
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers,initializer=_start_worker,
+                                                    initargs=(project,gallery)) as pool:
+            restarts = list(pool.map(_run_restart,seeds))
+        return restarts
+
 #    def _swap_cells(self,position1,position2):
 #        # move two cells
 #        print(' Switching cells {} and {}'.format(position1,position2))
@@ -253,4 +470,22 @@ class Engine:
 #        # ask the user to swap cells
 #        move_on = False
 #        while not move_on:
-#            ask = input(' Do you want to swap cells or finish?')
\ No newline at end of file
+#            ask = input(' Do you want to swap cells or finish?')
+
+### WORKER FUNCTIONS ###
+_worker = {}
+
+def _start_worker(project:Project,gallery:Gallery):
+    # keep the shared project and gallery in a pool worker
+    _worker['project'] = project
+    _worker['gallery'] = gallery
+
+def _run_restart(seed=None):
+    # one quiet restart in a pool worker
+    # forked workers inherit the same random state, so unseeded restarts draw fresh entropy
+    if seed is None:
+        random.seed()
+    with open(os.devnull,'w') as devnull, contextlib.redirect_stdout(devnull):
+        engine = Engine(project=_worker['project'])
+        results = engine.restart(_worker['gallery'],seed=seed)
+    return results,engine.grid
@@ -8,6 +8,9 @@ from plotting import *
 import time
 import sys
 import os
+import contextlib
+import concurrent.futures
+from itertools import repeat
 
 class Project:
     # read in inputs.txt and create variables
@@ -30,6 +33,11 @@ class Project:
         # where is the project located
         self.path = parameters.get('path')
         self.ig_username = parameters.get('ig_username')
+        self.ig_api = parameters.get('ig_api') # api root other than Instagram's, such as a local stand-in
+        self.ig_workers = parameters.get('ig_workers',8) # media downloaded at once
+        self.ig_retries = parameters.get('ig_retries',3) # tries for a failed request, waiting longer each time
+        self.ig_sync = parameters.get('ig_sync','ig_sync.json') # file in path with media already found, None to page through everything
+        self.ig_hashes = parameters.get('ig_hashes','video_hashes.json') # file in path with digests of videos already downloaded
 
         # how is the project structured?
         self.photos_folder = parameters.get('photos_folder')
@@ -57,6 +65,8 @@ class Project:
         self.grid_border_scale = parameters.get('grid_border_scale')
         self.grid_border_color = parameters.get('grid_border_color')
         self.grid_gif = parameters.get('grid_gif')
+        self.grid_tiled = parameters.get('grid_tiled',False) # write a Deep Zoom tile pyramid for grids too big for one image
+        self.tile_size = parameters.get('tile_size',256)
 
         # what content should be used?
         self.check_ig = parameters.get('check_ig')
@@ -65,10 +75,27 @@ class Project:
         self.use_videos = parameters.get('use_videos')
         self.video_tick = parameters.get('video_tick')
         self.remove_duplicates = parameters.get('remove_duplicates')
+        self.ingest_workers = parameters.get('ingest_workers',1) # open and analyze files in parallel when more than 1
+        self.ingest_mode = parameters.get('ingest_mode','process') # process or thread
+        self.scan_workers = parameters.get('scan_workers',1) # folders read at once when looking for files
+        self.image_budget = parameters.get('image_budget',512) # MB of decoded images kept in memory
+        self.duplicate_method = parameters.get('duplicate_method','dhash') # ahash, dhash, phash or pixels
+        self.duplicate_radius = parameters.get('duplicate_radius',4) # differing hash bits still counted as duplicate
+        self.color_cache = parameters.get('color_cache','color_cache.json') # file in path, None to analyze every run
+        self.tile_cache = parameters.get('tile_cache') # folder in path to keep cropped pictures between runs
         self.profile_size = parameters.get('profile_size')
 
         # how refined should the process be?
         self.trials = parameters.get('trials')
+        self.reseed_mode = parameters.get('reseed_mode','greedy') # greedy, or refine to follow it with local rounds of moves
+        self.optimizer = parameters.get('optimizer','swap') # swap or anneal
+        self.time_limit = parameters.get('time_limit')
+        self.anneal_proposal = parameters.get('anneal_proposal','random')
+        self.seed = parameters.get('seed')
+        self.workers = parameters.get('workers',1) # runs in parallel across processes when more than 1
+        self.update_layout = parameters.get('update_layout',False) # keep the saved layout and only place what changed
+        self.update_radius = parameters.get('update_radius',2) # steps around changed cells that are improved on update
+        self.layout_file = parameters.get('layout_file','layout.json') # file in path with the last layout, None to not save
 
         self.weights = {'difference': difference_weight,
                         'angle':angle_weight,
@@ -95,6 +122,11 @@ class Project:
         self.videos_path = '{}/{}'.format(self.path,self.videos_folder) if self.use_videos else False
         self.username = self.ig_username if self.check_ig else None
         self.download_path = self.downloads_folder
+        self.color_cache_path = '{}/{}'.format(self.path,self.color_cache) if self.color_cache else None
+        self.tile_cache_path = '{}/{}'.format(self.path,self.tile_cache) if self.tile_cache else None
+        self.ig_sync_path = '{}/{}'.format(self.path,self.ig_sync) if self.ig_sync else None
+        self.ig_hashes_path = '{}/{}'.format(self.path,self.ig_hashes) if self.ig_hashes else None
+        self.layout_path = '{}/{}'.format(self.path,self.layout_file) if self.layout_file else None
 
         self.start_time = self._timer()
         self.iterations = 0
@@ -174,9 +206,18 @@ class Project:
 
 class Finder:
     # finds media to use and coverts to images
-    def __init__(self,project:Project):
+    # with ingest workers, files are opened, cropped and analyzed in a pool
+    # and only colors and sources come back, so pixels are loaded through the image store
+    # files with colors in the cache are not sent to the pool
+    # analysis: Pixelation settings, the same as used for the gallery
+    def __init__(self,project:Project,analysis=None):
         self.project = project
-        self.library = Library()
+        self.library = Library(store=ImageStore(budget=project.image_budget*2**20))
+        self.analysis = analysis if analysis is not None else {}
+        self.analyzed = {}
+        self.stats = {}
+        self.cache = ColorCache(project.color_cache_path,stats=self.stats) if project.color_cache_path else None
+        self.pool = None
 
     def find(self):
         # look for files and links and convert
@@ -184,41 +225,103 @@ class Finder:
             self._check_ig()
 
         print('Looking for files...')
-        self._get_pictures()
-        if self.project.profile_path:
-            self._get_profile()
-        if self.project.stories_path:
-            self._get_stories()
-        if self.project.videos_path:
-            self._get_videos()
+        with self._ingest_pool() as self.pool:
+            self._get_pictures()
+            if self.project.profile_path:
+                self._get_profile()
+            if self.project.stories_path:
+                self._get_stories()
+            if self.project.videos_path:
+                self._get_videos()
+        self.pool = None
+
+    def _ingest_pool(self):
+        # pool of workers to ingest files, if used
+        workers = self.project.ingest_workers
+        if (workers is None) or (workers <= 1):
+            pool = contextlib.nullcontext()
+        elif self.project.ingest_mode == 'thread':
+            pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        else:
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        return pool
+
+    def _ingest(self,results):
+        # add worker results to the library as the first photo for each id
+        # colors left out by a worker are already in the cache
+        library = Library(store=self.library.store)
+        analyzed = {}
+        for ingested in results:
+            for id,source,colors in ingested:
+                library.add_photo(Photo(id,source=source))
+                if colors is not None:
+                    analyzed.setdefault(id,colors)
+
+        self.library.merge_library(library)
+        self.analyzed.update(analyzed)
+
+    def _cached(self,fn,frames=False):
+        # photo ids from a file that already have colors in the cache
+        # video frames are numbered in order, so stop at the first frame missing
+        cached = []
+        if self.cache is not None:
+            if frames:
+                while self.cache.get('{}_{}'.format(fn,len(cached)),self.analysis) is not None:
+                    cached.append('{}_{}'.format(fn,len(cached)))
+            elif self.cache.get(fn,self.analysis) is not None:
+                cached.append(fn)
+        return cached
 
     def _check_ig(self):
         # look if new media is in instagram
-        ig_user = IGAccount(self.project.username)
+        session = IGAuthentications.get_session(workers=self.project.ig_workers,retries=self.project.ig_retries)
+        ig_user = IGAccount(self.project.username,api=self.project.ig_api,session=session,sync_path=self.project.ig_sync_path)
         ig_user.ping()
         ig_downloader = IGDownloader(ig_user,photos_path=self.project.photos_path,videos_path=self.project.videos_path,
-                                     profile_path=self.project.profile_path,download_path=self.project.download_path)
+                                     profile_path=self.project.profile_path,download_path=self.project.download_path,
+                                     workers=self.project.ig_workers,hash_path=self.project.ig_hashes_path)
         ig_downloader.download_media()
         ### STORIES??
 
+    def _find_files(self,folder,extensions):
+        # find files and keep their stats for the color cache
+        scanned = dict(Common.scan_files(folder,extensions=extensions,workers=self.project.scan_workers))
+        self.stats.update(scanned)
+        return list(scanned)
+
     def _get_photos(self,folder,in_extensions=['jpg','png','bmp','gif'],crop=False):
         # find posted photos, profile or stories
-        files = Common.find_files(folder,extensions=in_extensions)
+        files = self._find_files(folder,in_extensions)
+        if self.pool is not None:
+            # cropped files are still opened to find the crop, but cached colors are not found again
+            cached = [self._cached(fn) for fn in files]
+            if not crop:
+                self._ingest([[(fn,None,None)] for fn,known in zip(files,cached) if known])
+                files = [fn for fn,known in zip(files,cached) if not known]
+                cached = [[] for fn in files]
+            self._ingest(self.pool.map(_ingest_photo,files,repeat(crop),repeat(self.analysis),cached))
+            return
+
         photos = [Photo(fn) for fn in files]
 
         if crop:
             photos = [j for k in [p.crop_photo() for p in photos] for j in k]
-        library = Library(photos)
+        library = Library(photos,store=self.library.store)
         self.library.merge_library(library)
 
     def _get_movies(self,folder,in_extensions=['mp4'],first_only=False):
         # find posted stories or videos
-        files = Common.find_files(folder,extensions=in_extensions)
-        library = Library()
+        files = self._find_files(folder,in_extensions)
+        if self.pool is not None:
+            cached = [self._cached(fn,frames=True) for fn in files]
+            self._ingest(self.pool.map(_ingest_video,files,repeat(self.project.video_tick),repeat(first_only),
+                                       repeat(self.analysis),cached))
+            return
+
+        library = Library(store=self.library.store)
         for fn in files:
             video = Video(fn)
-            photos = video.get_photos(tick=self.project.video_tick,first_only=first_only)
-            library.add_photos(photos)
+            library.add_photos(video.iter_photos(tick=self.project.video_tick,first_only=first_only))
 
         self.library.merge_library(library)
         
@@ -252,9 +355,19 @@ class Finder:
         print('\n ...found {} images'.format(self.library.size()))
         return self.library
 
+    def get_analyzed(self):
+        # return colors found during ingest by photo id
+        return self.analyzed
+
+    def get_stats(self):
+        # return file stats from the scan by file path
+        return self.stats
+
 class Collector:
     def __init__(self,finder:Finder):
         self.library = finder.get_library()
+        self.analyzed = finder.get_analyzed()
+        self.stats = finder.get_stats()
         self.gallery = None
         self.project = finder.project
 
@@ -262,14 +375,15 @@ class Collector:
 
     def _remove_duplicates(self):
         library = self.library
-        purge_count = library.purge()
+        purge_count = library.purge(method=self.project.duplicate_method,radius=self.project.duplicate_radius)
         if purge_count > 0:
             print(' ...removed {} duplicate photo{}'.format(purge_count,'s' if purge_count > 1 else ''))
         return library
 
     def create_gallery(self,remove_duplicates=True,round_color=True,grey_pct=0.75,dark_pct=0.6,
                     grey_threshold=16,dark_threshold=100,round_threshold=16,dimension=50,aspect=None,
-                    randomize=True,stories='stories',videos='videos',center=None):
+                    randomize=True,stories='stories',videos='videos',center=None,cache=None):
+        # cache: file of colors from earlier runs
 
         if remove_duplicates:
             library = self._remove_duplicates()
@@ -279,7 +393,7 @@ class Collector:
         gallery = Gallery.from_library(library,round_color=round_color,grey_pct=grey_pct,dark_pct=dark_pct,
                                        grey_threshold=grey_threshold,dark_threshold=dark_threshold,round_threshold=round_threshold,
                                        dimension=dimension,aspect=aspect,randomize=randomize,stories=stories,videos=videos,
-                                       center=center)
+                                       center=center,cache=ColorCache(cache,stats=self.stats) if cache else None,analyzed=self.analyzed)
 
         self.gallery = gallery
 
@@ -289,7 +403,7 @@ class Collector:
 
 class Printer:
     def __init__(self,collector:Collector,name='',dimension=200,dimension_small=20,
-                 target_aspect=None,debugging=False):
+                 target_aspect=None,durations=[500,1000],debugging=False):
         self.project = collector.project
         self.library = collector.library
         self.libary = collector.library
@@ -299,6 +413,11 @@ class Printer:
         self.dimension_small = dimension_small
         self.border_scale = self.project.grid_border_scale
         self.border_color = self.project.grid_border_color
+        self.tiles = TileCache(folder=self.project.tile_cache_path)
+
+        # very large grids are written as a pyramid of tiles instead of one image
+        self.tiled = self.project.grid_tiled
+        self.tiled_grid = None
 
         self.debugging = debugging
 
@@ -306,7 +425,10 @@ class Printer:
         self.width = 0
         self.width2 = 0
 
-        self.images = []
+        # only the latest render is kept, earlier steps are written to the animation as they come
+        self.image = None
+        self.animation = None
+        self.durations = durations # time per step and time to hold the final step
         if target_aspect:
             self.target_aspect = target_aspect[0]/target_aspect[1]
         else:
@@ -331,9 +453,15 @@ class Printer:
     def store_grid(self,grid:Grid,full=False,vibrant=True,display=False):
         # store a grid result image
 
+        # keep the grid to write as tiles when finished
+        if full & self.tiled:
+            self.tiled_grid = grid
+            return
+
         # print imags at full resolution
         if full:
             library = self.library
+            tiles = self.tiles
             dimension = self.dimension
             border = round(self.border_scale * self.dimension)
             border_color = self.border_color
@@ -343,6 +471,7 @@ class Printer:
         # print colors only
         else:
             library = None
+            tiles = None
             dimension = self.dimension_small
             border = 0
             border_color = None
@@ -351,14 +480,21 @@ class Printer:
 
         grid_image = grid.save_output(dimension=dimension,library=library,
                          secondary_scale=secondary_scale,vibrant=True,border=border,border_color=border_color,
-                         print_strength=print_strength)
-        self.images.append(grid_image)
+                         print_strength=print_strength,tiles=tiles)
+        self.image = grid_image
+
+        # add to the animation at the size of a color render
+        if self.project.grid_gif:
+            if self.animation is None:
+                gif_size = [max(1,round(d)) for d in grid._output_size(self.dimension_small,0)]
+                self.animation = Animation(self.project.project_path,gif_size,duration=self.durations[0])
+            self.animation.add(grid_image)
         return
 
-    def finalize(self,durations=[500,1000]):
+    def finalize(self):
         # save intermediate steps as a gif
         extension = self.project.grid_extension
-        extensions = [extension]
+        extensions = [extension,'dzi']
 
         gif = self.project.grid_gif
         if gif:
@@ -366,41 +502,54 @@ class Printer:
             extensions.append(gif_extension)
         save_name = self._find_next_name(self.project.project_path,self.name,extensions,number=True)
         
-        # save final grid as full-size render
-        final_image = self.images[-1]
-        if self.target_aspect:
-            current_aspect = final_image.height / final_image.width
-            # narrower than ratio means stretch width
-            if current_aspect > self.target_aspect:
-                x = 0
-                y = int(final_image.height/self.target_aspect - final_image.width)
-
-            # wider than ratio means stretch height
+        # save final grid as full-size render, or as tiles without padding to the target aspect
+        if self.tiled_grid is not None:
+            self.tiled_grid.save_tiles(self.project.project_path,save_name,dimension=self.dimension,library=self.library,
+                                       border=round(self.border_scale * self.dimension),border_color=self.border_color,
+                                       tile_size=self.project.tile_size,extension=extension,tiles=self.tiles)
+        else:
+            final_image = self.image
+            if self.target_aspect:
+                current_aspect = final_image.height / final_image.width
+                # narrower than ratio means stretch width
+                if current_aspect > self.target_aspect:
+                    x = 0
+                    y = int(final_image.height/self.target_aspect - final_image.width)
+
+                # wider than ratio means stretch height
+                else:
+                    x = int(final_image.width*self.target_aspect - final_image.height)
+                    y = 0
+
+                paste_box = (int(y/2),int(x/2),int(y/2)+final_image.width,int(x/2)+final_image.height)
+                image_save = Image.new('RGB',(final_image.width+y,final_image.height+x),color=self.border_color)
+                
+                image_save.paste(final_image,paste_box)
             else:
-                x = int(final_image.width*self.target_aspect - final_image.height)
-                y = 0
+                image_save = final_image
 
-            paste_box = (int(y/2),int(x/2),int(y/2)+final_image.width,int(x/2)+final_image.height)
-            image_save = Image.new('RGB',(final_image.width+y,final_image.height+x),color=self.border_color)
-            
-            image_save.paste(final_image,paste_box)
-        else:
-            image_save = final_image
+            image_save.save('{}/{}.{}'.format(self.project.project_path,save_name,extension))
 
-        image_save.save('{}/{}.{}'.format(self.project.project_path,save_name,extension))
+        # finish animation of all steps, holding the final step
+        if self.animation is not None:
+            self.animation.save('{}/{}.{}'.format(self.project.project_path,save_name,gif_extension),hold=self.durations[1])
+            self.animation = None
 
-        # save all steps as small size animation
-        if gif:
-            image_sizing = self.images[0]
-            gif_height = int(self.dimension_small * self.height)
-            gif_width = int(self.dimension_small * self.width)
+        os.startfile(self.project.project_path)
 
-            imgs = [im.resize((gif_width,gif_height)) for im in self.images]
-            duration = durations[0]
-            repeats = durations[1]//durations[0]
-            append_images = imgs[1:-1] + [imgs[-1]]*repeats
+### WORKER FUNCTIONS ###
+def _ingest_photo(fn,crop=False,analysis={},cached=[]):
+    # open, crop and analyze a photo file
+    photos = [Photo(fn)]
+    if crop:
+        photos = photos[0].crop_photo()
+    return [_ingest_result(photo,analysis,cached) for photo in photos]
 
-            imgs[0].save('{}/{}.{}'.format(self.project.project_path,save_name,gif_extension),
-                            save_all=True,duration=duration,append_images=append_images,loop=0)
+def _ingest_video(fn,tick=60,first_only=False,analysis={},cached=[]):
+    # pull frames from a video file and analyze them
+    return [_ingest_result(photo,analysis,cached) for photo in Video(fn).iter_photos(tick=tick,first_only=first_only)]
 
-        os.startfile(self.project.project_path)
\ No newline at end of file
+def _ingest_result(photo:Photo,analysis={},cached=[]):
+    # source and colors for a photo, leaving out colors already cached
+    colors = Pixelation.analyze([photo],**analysis)[0] if photo.id not in cached else None
+    return photo.id,photo.source,colors